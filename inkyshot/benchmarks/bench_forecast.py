@@ -0,0 +1,68 @@
+"""Benchmark the forecast parser against a sample met.no response.
+
+Run from the inkyshot directory with `python -m benchmarks.bench_forecast`. The previous arrow based
+parser is kept here as a reference, both for timing and to check the results match.
+"""
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import timeit
+
+import arrow
+
+from lib.forecast import parse_forecast
+
+FORECAST_PATH = Path(__file__).parent / "data" / "forecast-compact.json"
+
+# Shortly after the first entry of the sample forecast
+NOW = datetime(2024, 1, 15, 10, 17, 42, tzinfo=timezone.utc)
+
+
+def parse_forecast_arrow(timeseries, now):
+    """The parser get_weather used before, which reads every entry and filters the list several times"""
+    now = arrow.get(now)
+    tomorrow = now.shift(hours=+24)
+    weather_24hours = []
+    for t in timeseries:
+        tm = arrow.get(t['time'])
+        if tm < tomorrow:
+            temp = t['data']['instant']['details']['air_temperature']
+            humid = t['data']['instant']['details']['relative_humidity']
+            symbol = t['data']['next_1_hours']['summary']['symbol_code']
+            weather_24hours.append({
+                'time': tm,
+                'temperature': temp,
+                'humidity': humid,
+                'symbol': symbol,
+            })
+    weather_24hours = sorted(weather_24hours, key=lambda x: x['time'])
+    weather = [x for x in weather_24hours if x['time'] <= now.shift(hours=+1)][-1]
+    temperatures = [x['temperature'] for x in weather_24hours if x['time'] <= now.shift(days=+1)]
+    weather['max_temp'] = max(temperatures)
+    weather['min_temp'] = min(temperatures)
+    weather['max_humidity'] = max([x['humidity'] for x in weather_24hours if x['time'] <= now.shift(days=+1)])
+    return weather
+
+
+def best_of(func, repeat=5, number=200):
+    """Return the fastest time per call in seconds"""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def main():
+    timeseries = json.loads(FORECAST_PATH.read_text())["properties"]["timeseries"]
+
+    new = parse_forecast(timeseries, NOW)
+    old = parse_forecast_arrow(timeseries, NOW)
+    old["time"] = old["time"].strftime("%Y-%m-%dT%H:%M:%SZ")
+    assert new == old, f"Parsers disagree: {new} != {old}"
+
+    new_time = best_of(lambda: parse_forecast(timeseries, NOW))
+    old_time = best_of(lambda: parse_forecast_arrow(timeseries, NOW), number=20)
+    print(f"{len(timeseries)} entries")
+    print(f"parse_forecast        {new_time * 1e6:9.1f} us")
+    print(f"previous arrow parser {old_time * 1e6:9.1f} us ({old_time / new_time:.0f}x slower)")
+
+
+if __name__ == "__main__":
+    main()
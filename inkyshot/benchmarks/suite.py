@@ -0,0 +1,206 @@
+"""Microbenchmarks for the render and display driver hot paths.
+
+Run from the inkyshot directory:
+
+    python -m benchmarks.suite                      # print timings
+    python -m benchmarks.suite --save               # store them as the baseline for this machine
+    python -m benchmarks.suite --compare            # fail if anything got slower than the baseline
+    python -m benchmarks.suite --compare --threshold 0.1 fit_quote
+
+Baselines are JSON files in benchmarks/baselines, one per machine type, so run --save on the kind of
+device being deployed to (e.g. a Pi Zero) and compare against that. The display runs on the simulated
+Waveshare panel with refresh waits skipped, so no hardware is needed.
+"""
+import argparse
+from datetime import datetime, timezone
+import importlib.util
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+from PIL import Image
+
+APP_DIR = Path(__file__).parent.parent
+DATA_DIR = Path(__file__).parent / "data"
+BASELINE_DIR = Path(__file__).parent / "baselines"
+
+# Short and long quotes, so both the first and the last font sizes of the fit are exercised
+QUOTES = [
+    "Be yourself.",
+    "Whatever you are, be a good one.",
+    "The best way to predict the future is to invent it.",
+    "It does not matter how slowly you go as long as you do not stop.",
+    "You have power over your mind - not outside events. Realize this, and you will find strength.",
+    "Success is not final, failure is not fatal: it is the courage to continue that counts. "
+    "Keep going, even when the road ahead is long and you cannot yet see where it leads.",
+    "Do not go where the path may lead, go instead where there is no path and leave a trail. "
+    "The journey of a thousand miles begins with one step, and every one after it is taken the same way, "
+    "one at a time, until you look back and see how far you have come.",
+]
+
+
+def load_app():
+    """Import update-display.py against the simulated Waveshare panel, without running an update"""
+    defaults = {
+        "WAVESHARE": "1",
+        "DISPLAY_SIMULATOR": "1",
+        "SIMULATOR_TIME_SCALE": "0",
+        "SIMULATOR_OUTPUT": "",
+        "BALENA_API_KEY": "benchmark",
+        "BALENA_DEVICE_UUID": "benchmark",
+        "BALENA_SUPERVISOR_ADDRESS": "http://127.0.0.1:48484",
+        "BALENA_SUPERVISOR_API_KEY": "benchmark",
+        "DATA_DIR": tempfile.mkdtemp(prefix="inkyshot-benchmark-"),
+        "LATLONG": "51.5074,-0.1278",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    # Keep the info lines logged on every call out of the results
+    logging.basicConfig(level=logging.DEBUG if "DEBUG" in os.environ else logging.WARNING)
+    sys.path.insert(0, str(APP_DIR))
+    spec = importlib.util.spec_from_file_location("update_display", APP_DIR / "update-display.py")
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+
+class NullSPI:
+    """Stand-in for the epdconfig functions that only counts the bytes sent, so the driver's own cost is measured"""
+
+    def __init__(self, epdconfig):
+        self.bytes_sent = 0
+        epdconfig.digital_write = lambda pin, value: None
+        epdconfig.digital_read = lambda pin: 0
+        epdconfig.delay_ms = lambda delaytime: None
+        epdconfig.wait_until_idle = lambda pin, timeout_ms: True
+        epdconfig.spi_writebyte = self.write
+        epdconfig.spi_writebyte2 = self.write
+
+    def write(self, data):
+        self.bytes_sent += len(data)
+
+
+def recorded_forecast():
+    """Return the recorded met.no timeseries moved so that it starts at the current hour"""
+    timeseries = json.loads((DATA_DIR / "forecast-compact.json").read_text())["properties"]["timeseries"]
+    time_format = "%Y-%m-%dT%H:%M:%SZ"
+    first = datetime.strptime(timeseries[0]["time"], time_format)
+    shift = datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0) - first
+    for entry in timeseries:
+        entry["time"] = (datetime.strptime(entry["time"], time_format) + shift).strftime(time_format)
+    return timeseries
+
+
+def benchmarks(app):
+    """Return the benchmarks to run as name: function"""
+    from lib import epdconfig
+
+    rng = np.random.default_rng(0)
+    panel = app.backend.panel
+    horizontal = Image.fromarray(rng.random((panel.width, panel.height)) > 0.5)
+    vertical = Image.fromarray(rng.random((panel.height, panel.width)) > 0.5)
+    frame = panel.getbuffer(horizontal)
+    icon = Image.open(APP_DIR / "weather-icons" / "04.png")
+    icon.load()
+    # A smooth gradient, the worst case for error diffusion
+    gradient = Image.fromarray(np.add.outer(np.arange(app.HEIGHT), np.arange(app.WIDTH)).astype(np.uint8), "L")
+    colours = [rgb for _, rgb in app.backend.palette]
+
+    # The forecast is read through the data cache, as in a run where it was fetched earlier
+    app.data_cache.store("forecast", recorded_forecast(), 3600, key=f"{app.LAT:.4f},{app.LONG:.4f}")
+    weather = app.get_weather(app.LAT, app.LONG)
+    assert weather, "Recorded forecast didn't parse"
+
+    NullSPI(epdconfig)
+
+    def fit_quotes():
+        draw = app.ImageDraw.Draw(app.backend.new_image())
+        for quote in QUOTES:
+            # A cron run starts with nothing measured, so time the fit from scratch
+            app.text_metrics_cache.clear()
+            app.fit_quote(draw, quote, app.FONT_SIZE, "a")
+
+    return {
+        "getbuffer_horizontal": lambda: panel.getbuffer(horizontal),
+        "getbuffer_vertical": lambda: panel.getbuffer(vertical),
+        "epd_display": lambda: panel.display(frame),
+        "create_mask": lambda: app.create_mask(icon),
+        "fit_quote": fit_quotes,
+        "get_weather": lambda: app.get_weather(app.LAT, app.LONG),
+        "draw_weather": lambda: app.draw_weather(weather, app.backend.new_image(), "C"),
+        "dither_floyd_steinberg": lambda: app.dither(gradient, colours, "floyd-steinberg"),
+        "dither_bayer": lambda: app.dither(gradient, colours, "bayer"),
+    }
+
+
+def measure(func, repeat=5):
+    """Return the best and median time per call in microseconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    return {"best_us": min(times), "median_us": statistics.median(times)}
+
+
+def baseline_path():
+    return BASELINE_DIR / f"{platform.machine() or 'unknown'}.json"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--save", nargs="?", const=baseline_path(), type=Path, metavar="PATH",
+                        help="store the results as a baseline (default: %(const)s)")
+    parser.add_argument("--compare", nargs="?", const=baseline_path(), type=Path, metavar="PATH",
+                        help="compare the results with a baseline (default: %(const)s)")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fraction a benchmark may be slower than its baseline (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())["results"]
+
+    app = load_app()
+    results = {}
+    slower = []
+    for name, func in benchmarks(app).items():
+        if args.names and not any(n in name for n in args.names):
+            continue
+        results[name] = measure(func, args.repeat)
+        line = f"{name:22} {results[name]['best_us']:12.1f} us"
+        if baseline is not None and name in baseline:
+            change = results[name]["best_us"] / baseline[name]["best_us"] - 1
+            line += f" {change:+8.1%}"
+            if change > args.threshold:
+                line += "  SLOWER"
+                slower.append(name)
+        print(line)
+
+    if args.save:
+        if args.names and args.save.exists():
+            # Only some benchmarks were run, keep the baseline of the others
+            results = {**json.loads(args.save.read_text())["results"], **results}
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        args.save.write_text(json.dumps({
+            "created": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "results": results,
+        }, indent=2) + "\n")
+        print(f"Saved baseline to {args.save}")
+
+    if slower:
+        print(f"{len(slower)} benchmark(s) more than {args.threshold:.0%} slower than the baseline: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Shared HTTP client with pooled keep-alive connections, timeouts, retries and conditional requests"""
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds for each upstream host
+TIMEOUTS = {
+    "api.met.no": (5, 20),
+    "quotes.rest": (5, 10),
+    "ipinfo.io": (5, 10),
+    "api.balena-cloud.com": (5, 15),
+}
+DEFAULT_TIMEOUT = (5, 10)
+
+# The supervisor is on the local network, so fail fast
+LOCAL_TIMEOUT = (2, 5)
+
+
+def validators_of(response):
+    """Return the headers a later request can revalidate the response with"""
+    return {name: response.headers[name] for name in ("ETag", "Last-Modified") if name in response.headers}
+
+
+class Client:
+    """A requests session that every upstream call goes through"""
+
+    def __init__(self, retries=3, backoff=0.5):
+        self.session = requests.Session()
+        # Retries idempotent requests on connection errors and temporary server errors,
+        # waiting backoff * 2^n seconds between attempts. Retry-After is ignored, as a rate limited
+        # service may ask for a wait far longer than an update can take
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=2, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Last response and its validators for URLs fetched with conditional=True
+        self.validated = {}
+        # Number of retries and of requests that failed outright, for instrumentation
+        self.retries = 0
+        self.errors = 0
+
+    def timeout(self, url):
+        """Return the (connect, read) timeout for a URL"""
+        host = urlsplit(url).hostname or ""
+        if host in TIMEOUTS:
+            return TIMEOUTS[host]
+        if host in ("localhost", "127.0.0.1") or host.startswith(("10.", "172.", "192.168.")):
+            return LOCAL_TIMEOUT
+        return DEFAULT_TIMEOUT
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout(url))
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.errors += 1
+            raise
+        retries = getattr(response.raw, "retries", None)
+        if retries is not None and retries.history:
+            self.retries += len(retries.history)
+        return response
+
+    def get(self, url, headers=None, conditional=False, validators=None, **kwargs):
+        """GET a URL. With conditional set, the last response is revalidated with
+        If-None-Match/If-Modified-Since and reused if the server answers 304 Not Modified.
+
+        validators are the ETag and Last-Modified headers of a response stored elsewhere, e.g. by an
+        earlier process. They are sent when this client has no response of its own for the URL, and a
+        304 Not Modified is then returned as is for the caller to reuse what it stored."""
+        if not conditional:
+            return self.request("GET", url, headers=headers, **kwargs)
+        headers = dict(headers or {})
+        previous = self.validated.get(url)
+        if previous is not None:
+            validators = previous.headers
+        if validators:
+            if "ETag" in validators:
+                headers["If-None-Match"] = validators["ETag"]
+            if "Last-Modified" in validators:
+                headers["If-Modified-Since"] = validators["Last-Modified"]
+        response = self.request("GET", url, headers=headers, **kwargs)
+        if response.status_code == 304 and previous is not None:
+            logging.debug("Not modified: %s", url)
+            return previous
+        if response.status_code == 200 and validators_of(response):
+            self.validated[url] = response
+        return response
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
@@ -0,0 +1,114 @@
+"""On-disk cache for upstream data that serves stale entries while refreshing them in the background"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+
+
+class DataCache:
+    """Cache of JSON values stored as one file per name and key.
+
+    The key is what the value depends on (e.g. the location it was fetched for), so changing the configuration
+    makes it miss, and processes rendering for several locations from one directory don't evict each other.
+    Fresh entries are returned as is. Expired entries are returned straight away while a background thread
+    fetches a new value. Entries are also used whenever a fetch fails, so an offline device keeps showing the
+    last real data.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.stats = {"fresh": 0, "stale": 0, "miss": 0}
+
+    def _path(self, name, key=None):
+        if key is None:
+            return self.directory / f"{name}.json"
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+        return self.directory / f"{name}-{digest}.json"
+
+    def load(self, name, key=None):
+        """Return the stored entry for name if it was stored under the same key, otherwise None"""
+        try:
+            entry = json.loads(self._path(name, key).read_text())
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != key:
+            return None
+        return entry
+
+    def store(self, name, value, ttl=None, key=None, validators=None):
+        """Store a value that expires after ttl seconds, or never if ttl is None, along with the
+        validators (ETag, Last-Modified) of the response it came from, if any"""
+        entry = {
+            "key": key,
+            "value": value,
+            "expires": time.time() + ttl if ttl is not None else None,
+        }
+        if validators:
+            entry["validators"] = validators
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Unique per thread and process, as several render processes may share the directory
+            tmp_path = self._path(name, key).with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+            tmp_path.write_text(json.dumps(entry))
+            os.replace(tmp_path, self._path(name, key))
+        except OSError as err:
+            logging.error(f"Failed to cache {name}: {err}")
+
+    def _fetch(self, name, fetch, key):
+        """Call fetch, which returns (value, ttl) or (value, ttl, validators), and store the result.
+        Returns the value or None on failure"""
+        try:
+            value, ttl, *validators = fetch()
+        except Exception as err:
+            logging.error(f"Failed to fetch {name}: {err}")
+            return None
+        if value is None:
+            return None
+        self.store(name, value, ttl, key, *validators)
+        return value
+
+    def _refresh(self, name, fetch, key):
+        try:
+            self._fetch(name, fetch, key)
+        finally:
+            with self.lock:
+                self.refreshing.discard((name, key))
+
+    def get(self, name, fetch, key=None):
+        """Return the cached value for name, fetching it if there is none.
+
+        fetch is called with no arguments and returns (value, ttl), or (value, ttl, validators) to keep the
+        validators for revalidating the value later. A value of None means the fetch failed.
+        """
+        entry = self.load(name, key)
+        if entry is None:
+            self.stats["miss"] += 1
+            return self._fetch(name, fetch, key)
+        if entry["expires"] is None or entry["expires"] > time.time():
+            self.stats["fresh"] += 1
+            return entry["value"]
+        self.stats["stale"] += 1
+        with self.lock:
+            if (name, key) not in self.refreshing:
+                self.refreshing.add((name, key))
+                # Not a daemon thread, so a one-off run waits for the refresh before exiting,
+                # even if it's started from a daemon thread
+                threading.Thread(
+                    target=self._refresh, args=(name, fetch, key), name=f"refresh-{name}", daemon=False,
+                ).start()
+        logging.info("Using stale %s while it is refreshed", name)
+        return entry["value"]
+
+    def log_stats(self):
+        total = sum(self.stats.values())
+        if total:
+            logging.info(
+                "Data cache: %s fresh, %s stale, %s missed (%.0f%% hit rate)",
+                self.stats["fresh"], self.stats["stale"], self.stats["miss"],
+                100 * (self.stats["fresh"] + self.stats["stale"]) / total,
+            )
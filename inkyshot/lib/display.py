@@ -0,0 +1,137 @@
+"""Common interface to the supported displays, so drawing and refreshing don't depend on which one is attached.
+
+Screens are drawn in landscape into an image in the display's native mode (new_image), packed into the bytes
+the display is sent (pack) and pushed with the fastest refresh the display supports (push).
+"""
+from PIL import Image, ImageChops
+
+
+class WaveshareBackend:
+    """The Waveshare 2.13" V2 HAT, driven by lib.epd2in13_V2.
+
+    Frames are 1 bit per pixel in the panel's portrait RAM layout, one frame row per panel row, and a range of
+    rows can be written and refreshed on its own.
+    """
+    name = "waveshare"
+    mode = "1"
+    bits_per_pixel = 1
+    refresh_modes = ("full", "partial")
+    black = 0
+    white = 1
+
+    def __init__(self):
+        import lib.epd2in13_V2
+        self.panel = lib.epd2in13_V2.EPD()
+        # The panel is portrait, screens are drawn in landscape
+        self.width = self.panel.height
+        self.height = self.panel.width
+        self.row_bytes = (self.panel.width + 7) // 8
+        self.frame_size = self.row_bytes * self.panel.height
+        self.palette = [[self.black, [0, 0, 0]], [self.white, [255, 255, 255]]]
+
+    def new_image(self, size=None):
+        """Return a white image to draw on, the size of the display unless size is given"""
+        return Image.new(self.mode, size or (self.width, self.height), 255)
+
+    def from_indices(self, indices):
+        """Return the image for a numpy array of palette indices"""
+        return Image.fromarray(indices == self.white)
+
+    def invert(self, img):
+        """Return the image with black and white swapped"""
+        return ImageChops.invert(img)
+
+    def pack(self, img, rotate=False):
+        """Return the frame for an image, turned upside down if rotate is set"""
+        return self.panel.getbuffer(img, rotate)
+
+    def push(self, frame, region=None):
+        """Show a frame, returning the kind of refresh done. With region, a (first, last) range of frame rows,
+        only those rows are written and partially refreshed"""
+        if region is not None:
+            self.panel.init(self.panel.PART_UPDATE)
+            self.panel.displayPartialWindow(frame, region[0], region[1])
+            return "partial"
+        self.panel.init(self.panel.FULL_UPDATE)
+        # Writes both RAM banks so later partial refreshes have a base image
+        self.panel.displayPartBaseImage(frame)
+        return "full"
+
+    def timings(self):
+        """Return the seconds spent so far on each part of pushing frames"""
+        return {"transfer": self.panel.transfer_ms / 1000, "busy": self.panel.busy_ms / 1000}
+
+    def sleep(self):
+        """Put the panel into deep sleep, it keeps showing the last image"""
+        self.panel.sleep()
+
+
+class InkyBackend:
+    """An Inky pHAT, as returned by inky.auto() or the simulator.
+
+    Frames are the palette index of each pixel, one byte per pixel. The library only does full refreshes.
+    """
+    name = "inky"
+    mode = "P"
+    bits_per_pixel = 8
+    refresh_modes = ("full",)
+
+    def __init__(self, panel):
+        self.panel = panel
+        self.panel.set_border(panel.WHITE)
+        self.width = panel.WIDTH
+        self.height = panel.HEIGHT
+        self.row_bytes = self.width
+        self.frame_size = self.width * self.height
+        self.black = panel.BLACK
+        self.white = panel.WHITE
+        self.palette = [[self.black, [0, 0, 0]], [self.white, [255, 255, 255]]]
+        colour = getattr(panel, "colour", "black")
+        if colour == "red":
+            self.palette.append([panel.RED, [255, 0, 0]])
+        elif colour == "yellow":
+            self.palette.append([panel.YELLOW, [255, 255, 0]])
+
+    def new_image(self, size=None):
+        """Return a white image to draw on, the size of the display unless size is given"""
+        return Image.new(self.mode, size or (self.width, self.height), self.white)
+
+    def from_indices(self, indices):
+        """Return the image for a numpy array of palette indices"""
+        return Image.fromarray(indices, self.mode)
+
+    def invert(self, img):
+        """Return the image with black and white swapped"""
+        lut = list(range(256))
+        lut[self.black], lut[self.white] = self.white, self.black
+        return img.point(lut)
+
+    def pack(self, img, rotate=False):
+        """Return the frame for an image, turned upside down if rotate is set"""
+        frame = img.tobytes()
+        # One byte per pixel, so reversing the bytes turns the image around
+        return frame[::-1] if rotate else frame
+
+    def push(self, frame, region=None):
+        """Show a frame, returning the kind of refresh done. The whole display is refreshed even with a region"""
+        self.panel.set_image(Image.frombuffer(self.mode, (self.width, self.height), frame, "raw", self.mode, 0, 1))
+        self.panel.show()
+        return "full"
+
+    def timings(self):
+        """Return the seconds spent so far on each part of pushing frames"""
+        return {}
+
+    def sleep(self):
+        """Nothing to do, the display is only powered while refreshing"""
+
+
+def open_display(waveshare=False, simulator=False):
+    """Return the backend for the attached display"""
+    if waveshare:
+        return WaveshareBackend()
+    if simulator:
+        from lib.simulator import SimulatedInky
+        return InkyBackend(SimulatedInky())
+    import inky
+    return InkyBackend(inky.auto())
@@ -0,0 +1,74 @@
+"""Convert pictures to the few colours of an e-ink panel with ordered or error diffusion dithering"""
+import functools
+
+from lib.startup import LazyModule
+
+# Only imported once a picture is dithered, so importing METHODS stays cheap
+np = LazyModule("numpy")
+
+METHODS = ("floyd-steinberg", "bayer", "none")
+
+
+@functools.lru_cache(maxsize=None)
+def bayer_matrix(order):
+    """Return the 2^order square Bayer threshold matrix, scaled to 0..1"""
+    matrix = np.zeros((1, 1))
+    for _ in range(order):
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size
+
+
+def nearest(pixels, palette):
+    """Return the index of the palette colour closest to each pixel"""
+    distances = ((pixels[..., np.newaxis, :] - palette) ** 2).sum(axis=-1)
+    return distances.argmin(axis=-1)
+
+
+def ordered(pixels, palette):
+    """Bayer dithering: offset each pixel by its threshold in the tiled matrix, then take the nearest colour"""
+    height, width = pixels.shape[:2]
+    thresholds = np.tile(bayer_matrix(3), (height // 8 + 1, width // 8 + 1))[:height, :width] - 0.5
+    # Spread the offsets over the gap between neighbouring palette levels
+    spread = 255 / (len(palette) - 1)
+    return nearest(pixels + thresholds[..., np.newaxis] * spread, palette)
+
+
+def floyd_steinberg(pixels, palette):
+    """Floyd-Steinberg error diffusion.
+
+    Every pixel depends on the one to its left and the three above it, so all pixels on a line
+    x + 2y = t are independent of each other and are quantised together, one line per step.
+    """
+    height, width, channels = pixels.shape
+    # One column of padding on each side and a row below, so the errors can spill over the edges
+    work = np.zeros((height + 1, width + 2, channels))
+    work[:height, 1:width + 1] = pixels
+    indices = np.zeros((height, width), dtype=np.intp)
+    for t in range(width + 2 * (height - 1)):
+        ys = np.arange(max(0, (t - width + 2) // 2), min(height - 1, t // 2) + 1)
+        xs = t - 2 * ys
+        old = work[ys, xs + 1]
+        index = nearest(old, palette)
+        indices[ys, xs] = index
+        error = old - palette[index]
+        work[ys, xs + 2] += error * (7 / 16)
+        work[ys + 1, xs] += error * (3 / 16)
+        work[ys + 1, xs + 1] += error * (5 / 16)
+        work[ys + 1, xs + 2] += error * (1 / 16)
+    return indices
+
+
+def dither(image, colours, method="floyd-steinberg"):
+    """Return the index into colours, a list of RGB tuples, for each pixel of a PIL image"""
+    palette = np.array(colours, dtype=float)
+    if (palette == palette[:, :1]).all():
+        # Only greys, so one channel is enough
+        pixels = np.asarray(image.convert("L"), dtype=float)[..., np.newaxis]
+        palette = palette[:, :1]
+    else:
+        pixels = np.asarray(image.convert("RGB"), dtype=float)
+    if method == "floyd-steinberg":
+        return floyd_steinberg(pixels, palette)
+    if method == "bayer":
+        return ordered(pixels, palette)
+    return nearest(pixels, palette)
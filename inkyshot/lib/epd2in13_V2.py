@@ -29,6 +29,7 @@
 
 
 import logging
+import time
 from . import epdconfig
 import numpy as np
 
@@ -36,6 +37,9 @@ import numpy as np
 EPD_WIDTH       = 122
 EPD_HEIGHT      = 250
 
+class BusyTimeoutError(TimeoutError):
+    """The panel kept BUSY high for longer than epdconfig.BUSY_TIMEOUT_MS"""
+
 class EPD:
     def __init__(self):
         self.reset_pin = epdconfig.RST_PIN
@@ -44,6 +48,11 @@ class EPD:
         self.cs_pin = epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        self.last_transfer_ms = 0.0
+        # Running totals for instrumentation
+        self.transfer_ms = 0.0
+        self.busy_ms = 0.0
+        self.last_busy_ms = 0.0
         
     FULL_UPDATE = 0
     PART_UPDATE = 1
@@ -103,10 +112,26 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # Send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        start = time.monotonic()
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+        self.last_transfer_ms = (time.monotonic() - start) * 1000
+        self.transfer_ms += self.last_transfer_ms
+        logging.debug("Sent %d bytes in %.1f ms", len(data), self.last_transfer_ms)
         
     def ReadBusy(self):
-        while(epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)    
+        start = time.monotonic()
+        idle = epdconfig.wait_until_idle(self.busy_pin, epdconfig.BUSY_TIMEOUT_MS)      # 0: idle, 1: busy
+        self.last_busy_ms = (time.monotonic() - start) * 1000
+        self.busy_ms += self.last_busy_ms
+        if not idle:
+            raise BusyTimeoutError(f"Display still busy after {epdconfig.BUSY_TIMEOUT_MS} ms, check its connection")
+        logging.debug("Busy for %.1f ms", self.last_busy_ms)
 
     def TurnOnDisplay(self):
         self.send_command(0x22)
@@ -173,8 +198,7 @@ class EPD:
             self.send_data(self.lut_full_update[75])
 
             self.send_command(0x32)
-            for count in range(70):
-                self.send_data(self.lut_full_update[count])
+            self.send_data2(self.lut_full_update[0:70])
 
             self.send_command(0x4E)   # set RAM x address count to 0
             self.send_data(0x00)
@@ -189,8 +213,7 @@ class EPD:
             self.ReadBusy()
 
             self.send_command(0x32)
-            for count in range(70):
-                self.send_data(self.lut_partial_update[count])
+            self.send_data2(self.lut_partial_update[0:70])
 
             self.send_command(0x37)
             self.send_data(0x00)
@@ -210,36 +233,39 @@ class EPD:
             self.send_data(0x01)
         return 0
 
-    def getbuffer(self, image):
+    # With rotate set the image is turned upside down on the way, without copying it first
+    def getbuffer(self, image, rotate=False):
         if self.width%8 == 0:
             linewidth = int(self.width/8)
         else:
             linewidth = int(self.width/8) + 1
-         
-        buf = [0xFF] * (linewidth * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        
+
+        imwidth, imheight = image.size
         if(imwidth == self.width and imheight == self.height):
             logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):                    
-                    if pixels[x, y] == 0:
-                        x = imwidth - x
-                        buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
+            # Columns are mirrored and shifted by one bit: pixel x lands on bit (imwidth - x)
+            bits = np.ones((self.height, linewidth * 8), dtype=np.uint8)
+            bits[:, 1:imwidth + 1] = self._unpack_pixels(image, rotate)[:, ::-1]
         elif(imwidth == self.height and imheight == self.width):
             logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        newy = imwidth - newy - 1
-                        buf[int(newx / 8) + newy*linewidth] &= ~(0x80 >> (y % 8))
-        return buf   
-        
-        
+            # Rotated input: image row y becomes bit y of panel row x
+            bits = np.ones((self.height, linewidth * 8), dtype=np.uint8)
+            bits[:, :imheight] = self._unpack_pixels(image, rotate).T
+        else:
+            return bytearray([0xFF] * (linewidth * self.height))
+        return bytearray(np.packbits(bits, axis=1).tobytes())
+
+    def _unpack_pixels(self, image, rotate=False):
+        # 1 for white, 0 for black. Mode "1" images are read straight from
+        # their packed raw bytes, anything else is thresholded by PIL first.
+        if image.mode != '1':
+            image = image.convert('1')
+        imwidth, imheight = image.size
+        stride = (imwidth + 7) // 8
+        raw = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(imheight, stride)
+        pixels = np.unpackbits(raw, axis=1)[:, :imwidth]
+        return pixels[::-1, ::-1] if rotate else pixels
+
     def display(self, image):
         if self.width%8 == 0:
             linewidth = int(self.width/8)
@@ -247,9 +273,7 @@ class EPD:
             linewidth = int(self.width/8) + 1
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(image[0:linewidth * self.height])
         self.TurnOnDisplay()
         
     def displayPartial(self, image):
@@ -259,9 +283,7 @@ class EPD:
             linewidth = int(self.width/8) + 1
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(image[0:linewidth * self.height])
                 
                 
         # self.send_command(0x26)
@@ -270,6 +292,47 @@ class EPD:
                 # self.send_data(~image[i + j * linewidth])  
         self.TurnOnDisplayPart()
 
+    # Partial refresh that only writes buffer rows start..end (inclusive) to RAM.
+    # Rows map to RAM Y addresses counting down from 249, see data entry mode 0x01.
+    def displayPartialWindow(self, image, start, end):
+        if self.width%8 == 0:
+            linewidth = int(self.width/8)
+        else:
+            linewidth = int(self.width/8) + 1
+
+        ystart = self.height - 1 - start
+        yend = self.height - 1 - end
+
+        self.send_command(0x11) #data entry mode
+        self.send_data(0x01)
+        self.send_command(0x44) #set Ram-X address start/end position
+        self.send_data(0x00)
+        self.send_data(linewidth - 1)
+        self.send_command(0x45) #set Ram-Y address start/end position
+        self.send_data(ystart & 0xFF)
+        self.send_data(ystart >> 8)
+        self.send_data(yend & 0xFF)
+        self.send_data(yend >> 8)
+        self.send_command(0x4E) #set RAM x address count
+        self.send_data(0x00)
+        self.send_command(0x4F) #set RAM y address count
+        self.send_data(ystart & 0xFF)
+        self.send_data(ystart >> 8)
+
+        self.send_command(0x24)
+        self.send_data2(image[start * linewidth:(end + 1) * linewidth])
+
+        # Restore the full window for later full frame writes
+        self.send_command(0x45)
+        self.send_data(0xF9)
+        self.send_data(0x00)
+        self.send_data(0x00)
+        self.send_data(0x00)
+        self.send_command(0x4F)
+        self.send_data(0xF9)
+        self.send_data(0x00)
+        self.TurnOnDisplayPart()
+
     def displayPartBaseImage(self, image):
         if self.width%8 == 0:
             linewidth = int(self.width/8)
@@ -277,15 +340,11 @@ class EPD:
             linewidth = int(self.width/8) + 1
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(image[0:linewidth * self.height])
                 
                 
         self.send_command(0x26)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])  
+        self.send_data2(image[0:linewidth * self.height])
         self.TurnOnDisplay()
     
     def Clear(self, color):
@@ -296,9 +355,7 @@ class EPD:
         # logging.debug(linewidth)
         
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(color)   
+        self.send_data2(bytes([color]) * (linewidth * self.height))
         self.TurnOnDisplay()
 
     def sleep(self):
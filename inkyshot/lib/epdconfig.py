@@ -32,6 +32,38 @@ import logging
 import sys
 import time
 
+# SPI clock for the panel, 4 MHz unless overridden
+SPI_SPEED_HZ = int(os.environ.get('SPI_SPEED_HZ', 4000000))
+
+# Longest time to wait for the panel to finish an operation before giving up
+BUSY_TIMEOUT_MS = int(os.environ.get('BUSY_TIMEOUT_MS', 10000))
+
+# Poll interval for the BUSY pin when edge detection isn't available
+BUSY_POLL_MS = 5
+
+# How often to re-check the BUSY level while waiting for its edge, in case
+# the edge came between reading the pin and starting to wait for it
+EDGE_RECHECK_MS = 100
+
+
+def wait_for_low(GPIO, pin, timeout_ms, edge_detection=True):
+    """Wait until an input pin is low, waking on its falling edge if possible.
+    Returns whether the pin went low within the timeout and whether edge detection is usable."""
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    while GPIO.input(pin) == 1:
+        remaining_ms = (deadline - time.monotonic()) * 1000
+        if remaining_ms <= 0:
+            return False, edge_detection
+        if edge_detection:
+            try:
+                GPIO.wait_for_edge(pin, GPIO.FALLING, timeout=max(1, int(min(remaining_ms, EDGE_RECHECK_MS))))
+                continue
+            except RuntimeError as err:
+                logging.warning("Edge detection on the BUSY pin failed, polling instead: %s", err)
+                edge_detection = False
+        time.sleep(min(remaining_ms, BUSY_POLL_MS) / 1000.0)
+    return True, edge_detection
+
 
 class RaspberryPi:
     # Pin definition
@@ -45,6 +77,7 @@ class RaspberryPi:
         import RPi.GPIO
 
         self.GPIO = RPi.GPIO
+        self.edge_detection = True
 
         # SPI device, bus = 0, device = 0
         self.SPI = spidev.SpiDev(0, 0)
@@ -58,9 +91,17 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_until_idle(self, pin, timeout_ms):
+        idle, self.edge_detection = wait_for_low(self.GPIO, pin, timeout_ms, self.edge_detection)
+        return idle
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
+    def spi_writebyte2(self, data):
+        # writebytes2 accepts any buffer and splits it into spidev bufsiz chunks
+        self.SPI.writebytes2(data)
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -68,7 +109,7 @@ class RaspberryPi:
         self.GPIO.setup(self.DC_PIN, self.GPIO.OUT)
         self.GPIO.setup(self.CS_PIN, self.GPIO.OUT)
         self.GPIO.setup(self.BUSY_PIN, self.GPIO.IN)
-        self.SPI.max_speed_hz = 4000000
+        self.SPI.max_speed_hz = SPI_SPEED_HZ
         self.SPI.mode = 0b00
         return 0
 
@@ -108,6 +149,7 @@ class JetsonNano:
 
         import Jetson.GPIO
         self.GPIO = Jetson.GPIO
+        self.edge_detection = True
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -118,9 +160,20 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_until_idle(self, pin, timeout_ms):
+        idle, self.edge_detection = wait_for_low(self.GPIO, pin, timeout_ms, self.edge_detection)
+        return idle
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
+    def spi_writebyte2(self, data):
+        # The software SPI library only exposes a single byte transfer, so
+        # loop here under one DC/CS assertion instead of once per send_data
+        transfer = self.SPI.SYSFS_software_spi_transfer
+        for byte in bytes(data):
+            transfer(byte)
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -142,7 +195,10 @@ class JetsonNano:
         self.GPIO.cleanup()
 
 
-if os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
+if 'DISPLAY_SIMULATOR' in os.environ:
+    from .simulator import SimulatedPanel
+    implementation = SimulatedPanel(SPI_SPEED_HZ)
+elif os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
     implementation = RaspberryPi()
 else:
     implementation = JetsonNano()
@@ -0,0 +1,57 @@
+"""Turn a met.no locationforecast timeseries into the values drawn on the weather screen"""
+from datetime import datetime, timedelta, timezone
+
+# met.no timestamps are always UTC in this format
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def symbol_code(data):
+    """Return the weather symbol of a timeseries entry, preferring the shortest forecast period"""
+    for period in ("next_1_hours", "next_6_hours", "next_12_hours"):
+        if period in data:
+            return data[period]["summary"]["symbol_code"]
+    return None
+
+
+def parse_forecast(timeseries, now=None):
+    """Return the conditions for the current hour with the temperature range and max humidity of the next 24 hours.
+
+    The timeseries is sorted and all timestamps share one format, so they are compared as strings and
+    parsing stops at the first entry past the 24 hour horizon. Returns an empty dictionary if there is no
+    entry for the current hour.
+    """
+    now = (now or datetime.now(timezone.utc)).replace(microsecond=0)
+    current_limit = (now + timedelta(hours=1)).strftime(TIME_FORMAT)
+    horizon = (now + timedelta(hours=24)).strftime(TIME_FORMAT)
+
+    current = None
+    min_temp = max_temp = max_humidity = None
+    for entry in timeseries:
+        time = entry["time"]
+        if time >= horizon:
+            break
+        details = entry["data"]["instant"]["details"]
+        temp = details["air_temperature"]
+        humidity = details["relative_humidity"]
+        if min_temp is None:
+            min_temp = max_temp = temp
+            max_humidity = humidity
+        else:
+            min_temp = min(min_temp, temp)
+            max_temp = max(max_temp, temp)
+            max_humidity = max(max_humidity, humidity)
+        if time <= current_limit:
+            current = entry
+
+    if current is None:
+        return {}
+    details = current["data"]["instant"]["details"]
+    return {
+        "time": current["time"],
+        "temperature": details["air_temperature"],
+        "humidity": details["relative_humidity"],
+        "symbol": symbol_code(current["data"]),
+        "max_temp": max_temp,
+        "min_temp": min_temp,
+        "max_humidity": max_humidity,
+    }
@@ -0,0 +1,166 @@
+"""Per-update stage timings and cumulative counters, logged as JSON and exported for Prometheus"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+
+from lib.startup import import_module, profile
+
+# Label name of each counter with labels, e.g. refreshes{kind="full"}
+COUNTER_LABELS = {
+    "refreshes": "kind",
+    "data_cache": "result",
+    "render_cache": "result",
+}
+
+logger = logging.getLogger("metrics")
+
+
+class Metrics:
+    """Timings of the current update and counters kept across updates and restarts.
+
+    Counters are stored in state_path so cron runs, which each start a new process, add up. Counter names
+    are either plain (`http_retries`) or carry a label value after a colon (`refreshes:full`).
+    """
+
+    def __init__(self, state_path, textfile=None):
+        self.state_path = Path(state_path)
+        self.textfile = Path(textfile) if textfile else None
+        self.lock = threading.Lock()
+        self.counters = None
+        self.totals = {}
+        self.last = None
+        self.last_started = None
+        self.begin()
+
+    def begin(self):
+        """Start collecting a new update"""
+        self.stages = {}
+        self.values = {}
+        self.started = time.time()
+
+    def record(self, name, seconds):
+        """Add time to a stage of the current update"""
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + seconds
+        profile.record("stage", name, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the wrapped block as a stage of the current update"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def set(self, name, value):
+        """Record a value of the current update, e.g. how many font sizes were tried"""
+        self.values[name] = value
+
+    def count(self, name, amount=1):
+        """Increase a counter"""
+        with self.lock:
+            self._load_counters()
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_total(self, name, total):
+        """Increase a counter by how much a running total kept elsewhere in this process grew since the last call"""
+        previous = self.totals.get(name, 0)
+        if total > previous:
+            self.count(name, total - previous)
+        self.totals[name] = total
+
+    def _load_counters(self):
+        if self.counters is None:
+            try:
+                self.counters = json.loads(self.state_path.read_text())
+            except (OSError, ValueError):
+                self.counters = {}
+
+    def finish(self, **labels):
+        """Log the current update as a JSON line, store the counters and write the Prometheus textfile"""
+        with self.lock:
+            self._load_counters()
+            self.last = {
+                "time": datetime.fromtimestamp(self.started, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                **labels,
+                "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+                "values": dict(self.values),
+                "counters": dict(self.counters),
+            }
+            self.last_started = self.started
+            counters = dict(self.counters)
+        logger.info(json.dumps(self.last))
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.state_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(counters))
+            os.replace(tmp_path, self.state_path)
+            if self.textfile is not None:
+                # node_exporter may read the file at any time, so replace it in one go
+                tmp_path = self.textfile.with_name(f".{self.textfile.name}.tmp")
+                tmp_path.write_text(self.prometheus())
+                os.replace(tmp_path, self.textfile)
+        except OSError as err:
+            logging.error(f"Failed to write metrics: {err}")
+
+    def prometheus(self):
+        """Return the last update and the counters in the Prometheus text format"""
+        lines = []
+        last = self.last
+        if last is not None:
+            lines += [
+                "# HELP inkyshot_stage_seconds Time spent in each stage of the last update.",
+                "# TYPE inkyshot_stage_seconds gauge",
+            ]
+            lines += [
+                f'inkyshot_stage_seconds{{stage="{name}"}} {ms / 1000:.4f}' for name, ms in last["stages_ms"].items()
+            ]
+            for name, value in last["values"].items():
+                if isinstance(value, (int, float)):
+                    lines += [f"# TYPE inkyshot_{name} gauge", f"inkyshot_{name} {value}"]
+            lines += [
+                "# TYPE inkyshot_last_update_timestamp_seconds gauge",
+                f"inkyshot_last_update_timestamp_seconds {self.last_started:.0f}",
+            ]
+        counters = {}
+        for key, value in sorted((last or {}).get("counters", {}).items()):
+            name, _, label = key.partition(":")
+            counters.setdefault(name, []).append((label, value))
+        for name, samples in counters.items():
+            lines.append(f"# TYPE inkyshot_{name}_total counter")
+            for label, value in samples:
+                labels = f'{{{COUNTER_LABELS[name]}="{label}"}}' if label else ""
+                lines.append(f"inkyshot_{name}_total{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """Serve the metrics on http://<device>:port/metrics from a background thread"""
+        # Only needed with METRICS_PORT set, so it's not imported on every start
+        http_server = import_module("http.server")
+        metrics = self
+
+        class Handler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+
+        server = http_server.HTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logging.info("Serving metrics on port %s", port)
+        return server
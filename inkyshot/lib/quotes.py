@@ -0,0 +1,106 @@
+"""Local store of fetched quotes, so the quote screen doesn't depend on quotes.rest being reachable"""
+from contextlib import closing
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quotes (
+    id INTEGER PRIMARY KEY,
+    category TEXT NOT NULL,
+    language TEXT NOT NULL,
+    quote TEXT NOT NULL,
+    author TEXT,
+    day TEXT,
+    shown REAL,
+    UNIQUE (category, language, quote)
+);
+CREATE INDEX IF NOT EXISTS quotes_day ON quotes (category, language, day);
+CREATE INDEX IF NOT EXISTS quotes_shown ON quotes (category, language, shown);
+CREATE TABLE IF NOT EXISTS fetches (
+    category TEXT NOT NULL,
+    language TEXT NOT NULL,
+    attempted REAL NOT NULL,
+    PRIMARY KEY (category, language)
+);
+"""
+
+
+class QuoteStore:
+    """Quotes stored in SQLite by category and language.
+
+    Every quote fetched is kept, tagged with the local day it was fetched on as the quote of the day.
+    When there's no quote for today, e.g. while offline, the stored quotes are rotated, least recently
+    shown first, so none repeats before all the others were shown.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(str(self.path), timeout=10)
+        db.executescript(SCHEMA)
+        return db
+
+    def _run(self, func, default=None):
+        """Call func with a connection in a transaction, returning default if the database fails"""
+        try:
+            with self.lock, closing(self._connect()) as db, db:
+                return func(db)
+        except (sqlite3.Error, OSError) as err:
+            logging.error(f"Quote store failed: {err}")
+            return default
+
+    def add(self, category, language, quotes, day):
+        """Store quotes, a list of (quote, author), as the quotes of the day for day.
+        Quotes that are already stored are moved to day, as quotes.rest may repeat an earlier quote"""
+        # An upsert needs SQLite 3.24, Debian Buster has 3.27
+        self._run(lambda db: db.executemany(
+            "INSERT INTO quotes (category, language, quote, author, day) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (category, language, quote) DO UPDATE SET day = excluded.day",
+            [(category, language, quote, author, day) for quote, author in quotes],
+        ))
+
+    @staticmethod
+    def _show(db, row):
+        if row is None:
+            return None
+        db.execute("UPDATE quotes SET shown = ? WHERE id = ?", (time.time(), row[0]))
+        return row[1]
+
+    def quote_of_the_day(self, category, language, day):
+        """Return the quote fetched on day, or None if there isn't one"""
+        return self._run(lambda db: self._show(db, db.execute(
+            "SELECT id, quote FROM quotes WHERE category = ? AND language = ? AND day = ? ORDER BY id DESC LIMIT 1",
+            (category, language, day),
+        ).fetchone()))
+
+    def pick(self, category, language):
+        """Return the least recently shown quote, or None if there are none"""
+        # Never shown quotes sort first since NULL is the smallest value
+        return self._run(lambda db: self._show(db, db.execute(
+            "SELECT id, quote FROM quotes WHERE category = ? AND language = ? ORDER BY shown, id LIMIT 1",
+            (category, language),
+        ).fetchone()))
+
+    def should_fetch(self, category, language, interval):
+        """Return whether the last fetch attempt was more than interval seconds ago, recording a new attempt if so"""
+        def attempt(db):
+            now = time.time()
+            row = db.execute(
+                "SELECT attempted FROM fetches WHERE category = ? AND language = ?", (category, language)
+            ).fetchone()
+            if row is not None and now - row[0] < interval:
+                logging.info("Quotes were fetched %d seconds ago, not fetching again yet", now - row[0])
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO fetches (category, language, attempted) VALUES (?, ?, ?)",
+                (category, language, now),
+            )
+            return True
+        # Without a working store, fetching is the only way to get a quote
+        return self._run(attempt, default=True)
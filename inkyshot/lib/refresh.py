@@ -0,0 +1,115 @@
+"""Keep track of the last frame pushed to the display so unchanged frames
+can be skipped and small changes drawn with a partial refresh"""
+from collections import namedtuple
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+
+def boot_id():
+    """Return the kernel boot id, or None if it can't be read"""
+    try:
+        return Path(BOOT_ID_PATH).read_text().strip()
+    except OSError:
+        return None
+
+
+def changed_rows(old, new, row_bytes):
+    """Return the first and last differing row of two packed frames, or None if they match"""
+    if old is None or len(old) != len(new):
+        return 0, len(new) // row_bytes - 1
+    old = memoryview(old)
+    new = memoryview(new)
+    rows = [
+        row for row in range(len(new) // row_bytes)
+        if old[row * row_bytes:(row + 1) * row_bytes] != new[row * row_bytes:(row + 1) * row_bytes]
+    ]
+    if not rows:
+        return None
+    return rows[0], rows[-1]
+
+
+def changed_fraction(old, new, bits_per_pixel=1):
+    """Return the fraction of pixels that differ between two frames of the same size.
+    Frames are either packed 1 bit per pixel or 1 byte per pixel"""
+    if bits_per_pixel == 1:
+        diff = int.from_bytes(old, "big") ^ int.from_bytes(new, "big")
+        return bin(diff).count("1") / (len(new) * 8)
+    return sum(a != b for a, b in zip(old, new)) / len(new)
+
+
+# kind is "full", "partial" or "skip", rows the first and last changed row
+Decision = namedtuple("Decision", ["kind", "rows", "reason"])
+
+
+class RefreshPolicy:
+    """Choose the cheapest refresh that keeps the display clean.
+
+    Partial refreshes are quick and don't flash, but leave ghosting behind that builds up with every one,
+    with large changes and in the cold. A full refresh is done once too many partials were done, too much
+    time passed since the last full refresh, too much of the picture changed or it's too cold.
+    """
+
+    def __init__(self, partial=True, max_partials=10, max_change=0.25, full_interval=24 * 60 * 60, min_temperature=0):
+        self.partial = partial
+        self.max_partials = max_partials
+        self.max_change = max_change
+        self.full_interval = full_interval
+        self.min_temperature = min_temperature
+
+    def decide(self, old, new, row_bytes, partial_count=0, last_full=None, temperature=None, bits_per_pixel=1):
+        """Return the Decision for replacing the old frame on the display (None if unknown) with the new one"""
+        rows = changed_rows(old, new, row_bytes)
+        if rows is None:
+            return Decision("skip", None, "frame unchanged")
+        if not self.partial:
+            return Decision("full", rows, "display has no partial refresh")
+        if old is None or len(old) != len(new):
+            return Decision("full", rows, "previous frame unknown")
+        if partial_count >= self.max_partials:
+            return Decision("full", rows, f"{partial_count} partial refreshes since the last full one")
+        if self.full_interval and last_full is not None and time.time() - last_full >= self.full_interval:
+            return Decision("full", rows, f"last full refresh {(time.time() - last_full) / 3600:.1f} hours ago")
+        if temperature is not None and self.min_temperature is not None and temperature < self.min_temperature:
+            return Decision("full", rows, f"too cold for a partial refresh at {temperature:.1f}°")
+        fraction = changed_fraction(old, new, bits_per_pixel)
+        if fraction > self.max_change:
+            return Decision("full", rows, f"{fraction:.1%} of pixels changed")
+        return Decision("partial", rows, f"{fraction:.1%} of pixels changed in rows {rows[0]}-{rows[1]}")
+
+
+class FrameStore:
+    """Persist the last displayed frame and the number of partial refreshes since the last full one"""
+
+    def __init__(self, directory):
+        self.frame_path = Path(directory) / "last-frame.bin"
+        self.state_path = Path(directory) / "last-frame.json"
+
+    def load(self):
+        """Return (frame, partial_count, last_full), where last_full is the time of the last full refresh.
+        The frame is None if it's missing or from a previous boot, since the panel RAM it was diffed
+        against is gone after a power cycle"""
+        try:
+            state = json.loads(self.state_path.read_text())
+            frame = self.frame_path.read_bytes()
+        except (OSError, ValueError):
+            return None, 0, None
+        if state.get("boot_id") != boot_id():
+            logging.info("Last frame is from a previous boot, ignoring it")
+            return None, 0, None
+        return frame, state.get("partial_count", 0), state.get("last_full")
+
+    def save(self, frame, partial_count, last_full=None):
+        """Atomically store the frame that is now on the display"""
+        try:
+            self.frame_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.frame_path.with_suffix(".tmp")
+            tmp_path.write_bytes(bytes(frame))
+            os.replace(tmp_path, self.frame_path)
+            self.state_path.write_text(json.dumps({"boot_id": boot_id(), "partial_count": partial_count, "last_full": last_full}))
+        except OSError as err:
+            logging.error(f"Failed to save the last frame: {err}")
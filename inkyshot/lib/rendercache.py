@@ -0,0 +1,76 @@
+"""Cache of packed display frames addressed by a hash of everything they were drawn from"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+
+def file_version(path):
+    """Return a string that changes whenever the file at path is replaced or edited"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return f"{path}:missing"
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class RenderCache:
+    """Frames stored as one file per key, evicting the least recently used ones beyond max_bytes.
+
+    A key covers every input of the render, including the versions of the code and fonts, so a changed
+    input simply misses and stale frames age out instead of being invalidated.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(*inputs):
+        """Return the key for a render from its inputs, which must be JSON serialisable"""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.bin"
+
+    def get(self, key):
+        """Return the frame stored under key, or None"""
+        if not self.max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            frame = path.read_bytes()
+            # Mark it as recently used for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return frame
+
+    def put(self, key, frame):
+        """Store a frame and evict the least recently used ones if the cache is over its size"""
+        if not self.max_bytes:
+            return
+        with self.lock:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                tmp_path = self._path(key).with_suffix(".tmp")
+                tmp_path.write_bytes(bytes(frame))
+                os.replace(tmp_path, self._path(key))
+                self._evict()
+            except OSError as err:
+                logging.error(f"Failed to cache the frame: {err}")
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.glob("*.bin"):
+            stat = path.stat()
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            total -= size
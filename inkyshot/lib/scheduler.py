@@ -0,0 +1,123 @@
+"""In-process replacement for the cron schedule set up by start.sh"""
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+import logging
+import random
+import signal
+import threading
+import time
+
+
+class Schedule:
+    """Work out update times the same way as the crontab entry in start.sh:
+    every ALTERNATE_FREQUENCY minutes (`*/N` within each hour) if set, otherwise daily at UPDATE_HOUR
+    """
+
+    def __init__(self, alternate_frequency=None, update_hour=9):
+        self.alternate_frequency = alternate_frequency
+        self.update_hour = update_hour
+
+    def next_run(self, after):
+        """Return the first scheduled time strictly after the given local datetime"""
+        after = after.replace(second=0, microsecond=0)
+        if self.alternate_frequency:
+            for minute in range(after.minute + 1, 60):
+                if minute % self.alternate_frequency == 0:
+                    return after.replace(minute=minute)
+            return after.replace(minute=0) + timedelta(hours=1)
+        run = after.replace(hour=self.update_hour, minute=0)
+        if run <= after:
+            run += timedelta(days=1)
+        return run
+
+
+def sleep_until(when, stop):
+    """Sleep until the local datetime, returning False if stop was set first"""
+    # Sleep in short steps against the wall clock so suspends and clock changes are noticed
+    while not stop.is_set():
+        remaining = (when - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return True
+        stop.wait(min(remaining, 60))
+    return False
+
+
+def following_run(schedule, previous, now):
+    """Return the scheduled time to run at after the one at previous. If slots have passed since, that is
+    the latest of them, so missed slots are caught up on with a single run"""
+    run = schedule.next_run(previous)
+    while run <= now:
+        following = schedule.next_run(run)
+        if following > now:
+            break
+        run = following
+    return run
+
+
+def run_forever(job, schedule, jitter=0, run_now=True, prepare=None, lead=0):
+    """Call job on the schedule until SIGTERM or SIGINT is received.
+
+    Each scheduled run is delayed by a random 0 to `jitter` seconds. If the device was suspended or a run
+    overran and one or more slots were missed, the job runs once straight away to catch up.
+
+    If prepare is given, it is started in the background `lead` seconds before each run and job is called
+    with its result at the scheduled time. If prepare hasn't finished by then, job gets the last result
+    prepare returned instead.
+    """
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        logging.info("Received signal %s, shutting down", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prepare")
+    preparing = None
+    last_prepared = None
+
+    next_run = datetime.now() if run_now else schedule.next_run(datetime.now())
+    # The update on startup replaces the one start.sh used to run and isn't jittered
+    startup = run_now
+    while not stop.is_set():
+        delay = random.uniform(0, jitter) if jitter and not startup else 0
+        run_at = next_run + timedelta(seconds=delay)
+        logging.info("Next update at %s", run_at)
+
+        if prepare is not None:
+            if not sleep_until(run_at - timedelta(seconds=lead), stop):
+                break
+            # A previous preparation that overran is still the freshest one coming
+            if preparing is None or preparing.done():
+                preparing = executor.submit(prepare)
+            if startup or datetime.now() >= run_at:
+                # Nothing prepared yet, or the update is already due after a suspend or an overrun, so wait
+                # for its frame however long it takes
+                wait([preparing])
+        startup = False
+        if not sleep_until(run_at, stop):
+            break
+
+        late = (datetime.now() - run_at).total_seconds()
+        if late > 60:
+            logging.info("Catching up on an update missed by %d seconds", late)
+        started = time.monotonic()
+        try:
+            if prepare is None:
+                job()
+            else:
+                if preparing.done() and preparing.exception() is None:
+                    last_prepared = preparing.result()
+                elif preparing.done():
+                    logging.error("Preparing the update failed", exc_info=preparing.exception())
+                else:
+                    logging.warning("Update wasn't prepared in time, using the last prepared one")
+                if last_prepared is not None:
+                    job(last_prepared)
+        except Exception:
+            logging.exception("Display update failed")
+        logging.info("Update took %.1f seconds", time.monotonic() - started)
+        next_run = following_run(schedule, next_run, datetime.now())
+
+    executor.shutdown(wait=False)
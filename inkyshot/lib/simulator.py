@@ -0,0 +1,246 @@
+"""Simulated displays for running the render and refresh path without a panel attached.
+
+Set DISPLAY_SIMULATOR to use them. SimulatedPanel replaces the Raspberry Pi/Jetson implementation in
+epdconfig and behaves like the SSD1680 controller of the Waveshare 2.13" V2: it records every command and
+data byte, keeps the RAM written through the address window and holds BUSY high for as long as a refresh
+would take. SimulatedInky stands in for inky.auto(). Both save the image they would show as a PNG.
+"""
+from collections import deque
+import logging
+import os
+import time
+
+# Modelled duration of each kind of panel operation in milliseconds
+FULL_REFRESH_MS = float(os.environ.get("SIMULATOR_FULL_REFRESH_MS", 2000))
+PARTIAL_REFRESH_MS = float(os.environ.get("SIMULATOR_PARTIAL_REFRESH_MS", 300))
+OTHER_BUSY_MS = float(os.environ.get("SIMULATOR_OTHER_BUSY_MS", 10))
+
+# Multiplier from modelled to real time. 0 returns immediately while still accounting the modelled time
+TIME_SCALE = float(os.environ.get("SIMULATOR_TIME_SCALE", 1))
+
+# Where the image on the simulated display is saved after every refresh
+OUTPUT = os.environ.get("SIMULATOR_OUTPUT", "/tmp/inkyshot-display.png")
+
+# Resolution of the simulated Inky, e.g. 212x104 for the pHAT or 250x122 for the SSD1608 pHAT
+INKY_SIZE = tuple(int(x) for x in os.environ.get("SIMULATOR_INKY_SIZE", "212x104").split("x"))
+
+# Third colour of the simulated Inky: black for a black and white one, red or yellow
+INKY_COLOUR = os.environ.get("SIMULATOR_INKY_COLOUR", "black")
+
+# Display update control (0x22) values and the kind of refresh the following activation runs
+UPDATE_SEQUENCES = {
+    0xC7: "full",
+    0xF7: "full",
+    0x0C: "partial",
+    0x0F: "partial",
+    0xCF: "partial",
+    0xFF: "partial",
+}
+
+
+class SimulatedPanel:
+    """epdconfig implementation backed by a model of the panel controller"""
+    # Pin definition
+    RST_PIN         = 17
+    DC_PIN          = 25
+    CS_PIN          = 8
+    BUSY_PIN        = 24
+
+    # RAM is 16 bytes (128 source lines) wide and 250 gate lines high
+    RAM_WIDTH = 16
+    RAM_HEIGHT = 250
+
+    def __init__(self, spi_speed_hz=4000000, output=OUTPUT):
+        self.spi_speed_hz = spi_speed_hz
+        self.output = output
+        self.pins = {self.RST_PIN: 1, self.DC_PIN: 0, self.CS_PIN: 1}
+        # Commands with their data bytes, most recent last
+        self.commands = deque(maxlen=1000)
+        self.ram = {0x24: bytearray([0xFF] * (self.RAM_WIDTH * self.RAM_HEIGHT)),
+                    0x26: bytearray([0xFF] * (self.RAM_WIDTH * self.RAM_HEIGHT))}
+        self.reset_registers()
+        self.busy_until = 0.0
+        self.sleeping = False
+        self.stats = {
+            "commands": 0,
+            "data_bytes": 0,
+            "transfer_ms": 0.0,
+            "busy_ms": 0.0,
+            "delay_ms": 0.0,
+            "full_refreshes": 0,
+            "partial_refreshes": 0,
+        }
+
+    def reset_registers(self):
+        self.entry_mode = 0x03
+        self.x_window = (0, self.RAM_WIDTH - 1)
+        self.y_window = (0, self.RAM_HEIGHT - 1)
+        self.x = 0
+        self.y = 0
+        self.update_sequence = None
+        self.ram_target = None
+
+    def digital_write(self, pin, value):
+        if pin == self.RST_PIN and value == 0:
+            # Hardware reset wakes the controller up and restores its registers, RAM is kept
+            self.sleeping = False
+            self.reset_registers()
+        self.pins[pin] = value
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            return 1 if time.monotonic() < self.busy_until else 0
+        return self.pins.get(pin, 0)
+
+    def wait_until_idle(self, pin, timeout_ms):
+        remaining_ms = (self.busy_until - time.monotonic()) * 1000
+        if remaining_ms > timeout_ms:
+            time.sleep(timeout_ms / 1000.0)
+            return False
+        if remaining_ms > 0:
+            time.sleep(remaining_ms / 1000.0)
+        return True
+
+    def delay_ms(self, delaytime):
+        self.stats["delay_ms"] += delaytime
+        if TIME_SCALE:
+            time.sleep(delaytime * TIME_SCALE / 1000.0)
+
+    def spi_writebyte(self, data):
+        self.spi_writebyte2(data)
+
+    def spi_writebyte2(self, data):
+        data = bytes(data)
+        self.stats["transfer_ms"] += len(data) * 8 * 1000 / self.spi_speed_hz
+        if self.pins[self.DC_PIN] == 0:
+            for command in data:
+                self.command(command)
+        else:
+            self.stats["data_bytes"] += len(data)
+            self.write_data(data)
+
+    def module_init(self):
+        return 0
+
+    def module_exit(self):
+        logging.debug("Simulated panel: %s", self.stats)
+
+    def busy(self, milliseconds):
+        """Hold BUSY high for the modelled duration"""
+        self.stats["busy_ms"] += milliseconds
+        self.busy_until = time.monotonic() + milliseconds * TIME_SCALE / 1000.0
+
+    def command(self, command):
+        self.stats["commands"] += 1
+        self.commands.append((command, bytearray()))
+        self.ram_target = None
+        if self.sleeping:
+            logging.warning("Simulated panel: command 0x%02X sent during deep sleep", command)
+        elif command == 0x12:
+            # Soft reset
+            self.reset_registers()
+            self.busy(OTHER_BUSY_MS)
+        elif command == 0x20:
+            self.activate()
+        elif command in self.ram:
+            self.ram_target = command
+
+    def write_data(self, data):
+        command, params = self.commands[-1] if self.commands else (None, None)
+        if params is None or self.sleeping:
+            return
+        params.extend(data)
+        if self.ram_target is not None:
+            self.write_ram(self.ram[self.ram_target], data)
+        elif command == 0x11:
+            self.entry_mode = params[0]
+        elif command == 0x44 and len(params) >= 2:
+            self.x_window = (params[0], params[1])
+        elif command == 0x45 and len(params) >= 4:
+            self.y_window = (params[0] | params[1] << 8, params[2] | params[3] << 8)
+        elif command == 0x4E:
+            self.x = params[0]
+        elif command == 0x4F and len(params) >= 2:
+            self.y = params[0] | params[1] << 8
+        elif command == 0x22:
+            self.update_sequence = params[0]
+        elif command == 0x10 and params[0] & 0x03:
+            self.sleeping = True
+
+    def write_ram(self, ram, data):
+        """Write bytes at the address counters, moving them through the window like the controller does"""
+        x_step = 1 if self.entry_mode & 0x01 else -1
+        y_step = 1 if self.entry_mode & 0x02 else -1
+        # Windows are given in the order the counters move through them
+        x_first, x_last = self.x_window
+        y_first, y_last = self.y_window
+        for byte in data:
+            if 0 <= self.x < self.RAM_WIDTH and 0 <= self.y < self.RAM_HEIGHT:
+                ram[self.y * self.RAM_WIDTH + self.x] = byte
+            # Entry mode bit 2 clear means the X counter runs first
+            if self.x == x_last:
+                self.x = x_first
+                self.y = y_first if self.y == y_last else self.y + y_step
+            else:
+                self.x += x_step
+
+    def activate(self):
+        """Master activation (0x20): run the display update sequence selected with 0x22"""
+        kind = UPDATE_SEQUENCES.get(self.update_sequence)
+        if kind == "full":
+            self.stats["full_refreshes"] += 1
+            self.busy(FULL_REFRESH_MS)
+        elif kind == "partial":
+            self.stats["partial_refreshes"] += 1
+            self.busy(PARTIAL_REFRESH_MS)
+        else:
+            self.busy(OTHER_BUSY_MS)
+            return
+        logging.debug("Simulated panel: %s refresh", kind)
+        if self.output:
+            self.image().save(self.output)
+
+    def image(self):
+        """Decode the black/white RAM into the landscape image update-display.py draws"""
+        import numpy as np
+        from PIL import Image
+        ram = np.frombuffer(bytes(self.ram[0x24]), dtype=np.uint8).reshape(self.RAM_HEIGHT, self.RAM_WIDTH)
+        # The driver writes buffer row 0 to the last gate line, see data entry mode 0x01
+        bits = np.unpackbits(ram[::-1], axis=1)[:, :122]
+        return Image.fromarray(bits.T.astype(bool))
+
+
+class SimulatedInky:
+    """Stand-in for an Inky pHAT returned by inky.auto()"""
+    WHITE = 0
+    BLACK = 1
+    RED = 2
+    YELLOW = 2
+
+    # Black, white and red, by palette index
+    PALETTE = [255, 255, 255, 0, 0, 0, 255, 0, 0]
+
+    def __init__(self, size=INKY_SIZE, output=OUTPUT, colour=INKY_COLOUR):
+        self.WIDTH, self.HEIGHT = size
+        self.colour = colour
+        self.output = output
+        self.border_colour = self.WHITE
+        self.buf = None
+        self.stats = {"busy_ms": 0.0, "full_refreshes": 0}
+
+    def set_border(self, colour):
+        self.border_colour = colour
+
+    def set_image(self, image):
+        self.buf = image.copy()
+
+    def show(self, busy_wait=True):
+        self.stats["full_refreshes"] += 1
+        self.stats["busy_ms"] += FULL_REFRESH_MS
+        if busy_wait and TIME_SCALE:
+            time.sleep(FULL_REFRESH_MS * TIME_SCALE / 1000.0)
+        logging.debug("Simulated Inky: %s", self.stats)
+        if self.output and self.buf is not None:
+            image = self.buf.copy()
+            image.putpalette(self.PALETTE[:6] + ([255, 255, 0] if self.colour == "yellow" else self.PALETTE[6:]))
+            image.save(self.output)
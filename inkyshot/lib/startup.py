@@ -0,0 +1,83 @@
+"""Lazy imports and start-up timing for update-display.py"""
+from contextlib import contextmanager
+import importlib
+import logging
+import os
+import sys
+import time
+
+
+def process_age():
+    """Return seconds since this process was started, or None if /proc isn't available"""
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name can contain spaces, so split after its closing bracket
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+class StartupProfile:
+    """Collect wall time spent on imports and start-up stages"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        # Time spent before this module was imported: interpreter start-up and earlier imports
+        self.before_start = process_age()
+        self.timings = []
+        self.enabled = True
+
+    def record(self, kind, name, seconds):
+        if self.enabled:
+            self.timings.append((kind, name, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        """Time the wrapped block as a named stage"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record("stage", name, time.monotonic() - start)
+
+    def report(self):
+        """Log every recorded import and stage, slowest first, and stop recording"""
+        total = time.monotonic() - self.started
+        logging.info("Start-up profile:")
+        if self.before_start is not None:
+            logging.info("  %-8s %-28s %8.1f ms", "process", "interpreter start-up", self.before_start * 1000)
+        for kind, name, seconds in sorted(self.timings, key=lambda t: t[2], reverse=True):
+            logging.info("  %-8s %-28s %8.1f ms", kind, name, seconds * 1000)
+        logging.info("  %-8s %-28s %8.1f ms", "total", "since first import", total * 1000)
+        self.enabled = False
+
+
+profile = StartupProfile()
+
+
+class LazyModule:
+    """Stand-in for a module that is only imported when one of its attributes is first used"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            start = time.monotonic()
+            self._module = importlib.import_module(self._name)
+            profile.record("import", self._name, time.monotonic() - start)
+        return getattr(self._module, attr)
+
+
+def import_module(name):
+    """Import a module now, recording how long it took the first time"""
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.monotonic()
+    module = importlib.import_module(name)
+    profile.record("import", name, time.monotonic() - start)
+    return module
@@ -0,0 +1,58 @@
+"""Background thread that owns the display, so refreshes don't block fetching and drawing"""
+from concurrent.futures import Future
+import logging
+import threading
+
+
+class DisplayWorker:
+    """Run display pushes one at a time on a dedicated thread.
+
+    Only the most recent submission waits while the display is busy. Submitting again before it has
+    started replaces it, and the replaced one's future is cancelled, so a burst of updates ends in a
+    single refresh showing the latest frame.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = None
+        self.closed = False
+        # A daemon thread so a crashed update doesn't keep the process alive; close() waits for it
+        self.thread = threading.Thread(target=self._run, name="display", daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        """Queue func(*args) to run on the display thread and return a future for its result"""
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Display worker is closed")
+            if self.pending is not None and self.pending[0].cancel():
+                logging.info("Dropping a frame that was replaced before it was shown")
+            self.pending = (future, func, args)
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                future, func, args = self.pending
+                self.pending = None
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args)
+            except BaseException as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Finish the current and pending pushes and stop the thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,232 @@
+"""Draw the frames of a fleet of Inkyshots in one place and serve them to the devices over HTTP.
+
+Each profile in the RENDER_PROFILES JSON file is named after a device and holds the environment variables the
+device would otherwise be configured with, for example:
+
+    {
+        "kitchen": {"WAVESHARE": "1", "MODE": "weather", "LATLONG": "51.5074,-0.1278"},
+        "hall": {"MODE": "alternate", "FONT": "Roboto", "SIMULATOR_INKY_SIZE": "250x122"}
+    }
+
+Every RENDER_INTERVAL seconds each screen of each profile is drawn by update-display.py against the simulated
+display, in a pool of processes that share the data, quote and render caches in DATA_DIR. Profiles that would
+draw the same screen are only drawn once and identical frames are stored once. Devices with RENDER_SERVER set
+fetch the packed frame from /frames/<profile>/<screen>, with the hash of the frame as its ETag.
+"""
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+APP_DIR = Path(__file__).parent
+
+# Read the preset environment variables and overwrite the default ones
+if "DEBUG" in os.environ:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+DATA_DIR = os.environ["DATA_DIR"] if "DATA_DIR" in os.environ else "/data"
+
+RENDER_PROFILES = os.environ["RENDER_PROFILES"] if "RENDER_PROFILES" in os.environ else str(Path(DATA_DIR) / "render-profiles.json")
+
+RENDER_PORT = int(os.environ["RENDER_PORT"]) if "RENDER_PORT" in os.environ else 8080
+
+# Seconds between drawing all the profiles
+RENDER_INTERVAL = int(os.environ["RENDER_INTERVAL"]) if "RENDER_INTERVAL" in os.environ else 300
+
+# Number of screens drawn at the same time
+RENDER_WORKERS = int(os.environ["RENDER_WORKERS"]) if "RENDER_WORKERS" in os.environ else os.cpu_count()
+
+# Seconds to wait for one screen to be drawn, which includes fetching its data
+RENDER_TIMEOUT = 120
+
+# Settings every screen is drawn with. The display is simulated, and there's no device to talk to
+RENDER_DEFAULTS = {
+    "DISPLAY_SIMULATOR": "1",
+    "SIMULATOR_OUTPUT": "",
+    "SIMULATOR_TIME_SCALE": "0",
+    "BALENA_API_KEY": "",
+    "BALENA_DEVICE_UUID": "",
+    "BALENA_SUPERVISOR_ADDRESS": "",
+    "BALENA_SUPERVISOR_API_KEY": "",
+}
+
+
+def render(settings):
+    """Draw one screen with update-display.py configured by settings.
+    Returns the screen drawn, the packed frame and the current temperature, if the weather was fetched."""
+    # Every render runs in a new process, so the settings only apply to this one
+    os.environ.update(settings)
+    spec = importlib.util.spec_from_file_location("update_display", APP_DIR / "update-display.py")
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    try:
+        target_display, frame = app.prepare_update()
+    finally:
+        app.display_worker.close()
+    return target_display, bytes(frame), app.ambient_temperature
+
+
+def profile_screens(name, settings):
+    """Return the screens to draw for a profile"""
+    mode = settings.get("MODE", "quote")
+    # In alternate mode the device keeps track of which one is next and asks for it
+    screens = ["quote", "weather"] if mode == "alternate" else [mode]
+    if "weather" in screens and not settings.get("LATLONG") and not settings.get("WEATHER_LOCATION"):
+        # Looking up the location from the IP address would find the server, not the device
+        logging.error(f"Profile {name} has no LATLONG or WEATHER_LOCATION, not drawing its weather")
+        screens.remove("weather")
+    return screens
+
+
+def render_settings(name, settings, screen):
+    """Return the environment to draw one screen of a profile with"""
+    render_env = {**RENDER_DEFAULTS, **settings, "MODE": screen}
+    if render_env.get("INKY_MESSAGE") == "":
+        # A blank message shows the device name
+        render_env.setdefault("DEVICE_NAME", name)
+    return render_env
+
+
+def load_profiles():
+    """Return the profiles by name, or None if the file can't be read"""
+    try:
+        profiles = json.loads(Path(RENDER_PROFILES).read_text())
+    except (OSError, ValueError) as err:
+        logging.error(f"Failed to load the render profiles: {err}")
+        return None
+    # Environment variables are strings
+    return {name: {k: str(v) for k, v in settings.items()} for name, settings in profiles.items()}
+
+
+class Frames:
+    """The latest frame of each profile and screen. Identical frames are stored once, under their hash"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.screens = {}
+
+    def update(self, rendered, screens):
+        """Store the rendered screens, given as (profile, screen): (screen drawn, frame, temperature).
+        Screens that failed to render keep their last frame, and those not in screens are dropped."""
+        with self.lock:
+            entries = {key: entry for key, entry in self.screens.items() if key in screens}
+            frames = {}
+            for key, (target_display, frame, temperature) in rendered.items():
+                digest = hashlib.sha256(frame).hexdigest()
+                frames[digest] = frame
+                entries[key] = (digest, target_display, temperature)
+            for digest, _, _ in entries.values():
+                if digest not in frames:
+                    frames[digest] = self.frames[digest]
+            self.frames, self.screens = frames, entries
+
+    def get(self, profile, screen):
+        """Return the frame's hash, the screen drawn, the temperature and the frame, or None if there's none"""
+        with self.lock:
+            if (profile, screen) not in self.screens:
+                return None
+            digest, target_display, temperature = self.screens[(profile, screen)]
+            return digest, target_display, temperature, self.frames[digest]
+
+
+def render_all(pool, profiles, frames):
+    """Draw every screen of every profile"""
+    start = time.monotonic()
+    # Profiles with the same settings for a screen share its render
+    jobs = {}
+    for name, settings in profiles.items():
+        for screen in profile_screens(name, settings):
+            key = json.dumps(render_settings(name, settings, screen), sort_keys=True)
+            jobs.setdefault(key, []).append((name, screen))
+    # One quote screen is drawn ahead of the others, so they find the quote of the day already stored
+    # instead of all fetching it at once from the rate limited quote service
+    keys = sorted(jobs, key=lambda key: json.loads(key)["MODE"] != "quote")
+    results = {}
+    if keys:
+        results[keys[0]] = pool.apply_async(render, (json.loads(keys[0]),))
+        results[keys[0]].wait(RENDER_TIMEOUT)
+    for key in keys[1:]:
+        results[key] = pool.apply_async(render, (json.loads(key),))
+
+    rendered = {}
+    for key, result in results.items():
+        try:
+            target_display, frame, temperature = result.get(RENDER_TIMEOUT)
+        except Exception as err:
+            logging.error(f"Failed to render {', '.join(f'{name}/{screen}' for name, screen in jobs[key])}: {err!r}")
+            continue
+        for screen in jobs[key]:
+            rendered[screen] = (target_display, frame, temperature)
+    frames.update(rendered, {screen for screens in jobs.values() for screen in screens})
+    logging.info(
+        "Rendered %s screens with %s renders into %s distinct frames in %.2f seconds",
+        len(rendered), len(jobs), len({frame for _, frame, _ in rendered.values()}), time.monotonic() - start,
+    )
+
+
+def serve(frames, port):
+    """Serve the frames on http://<server>:port/frames/<profile>/<screen> from background threads"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlsplit(self.path).path.strip("/").split("/")
+            if len(parts) != 3 or parts[0] != "frames":
+                self.send_error(404)
+                return
+            entry = frames.get(unquote(parts[1]), parts[2])
+            if entry is None:
+                self.send_error(404, "No frame for this profile and screen")
+                return
+            digest, target_display, temperature, frame = entry
+            etag = f'"{digest}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(frame)))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("X-Inkyshot-Display", target_display)
+            if temperature is not None:
+                self.send_header("X-Inkyshot-Temperature", str(temperature))
+            self.end_headers()
+            self.wfile.write(frame)
+
+        def log_message(self, format, *args):
+            logging.debug("Frame request: " + format, *args)
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, name="frames", daemon=True).start()
+    logging.info("Serving frames on port %s", port)
+    return server
+
+
+def main():
+    frames = Frames()
+    serve(frames, RENDER_PORT)
+    profiles = {}
+    # A new process for every render, so each starts from its own settings. Spawned rather than forked,
+    # as the server threads may hold locks at the time of the fork
+    with multiprocessing.get_context("spawn").Pool(RENDER_WORKERS, maxtasksperchild=1) as pool:
+        while True:
+            # Reloaded every time, so profiles can be changed without a restart
+            profiles = load_profiles() or profiles
+            render_all(pool, profiles, frames)
+            time.sleep(RENDER_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,11 @@ export DEVICE_NAME=$(curl -sX GET "https://api.balena-cloud.com/v5/device?\$filt
 -H "Authorization: Bearer $BALENA_API_KEY" | \
 jq -r ".d | .[0] | .device_name")
 
+# In daemon mode the update script stays resident and schedules its own updates
+if [[ -n "${DAEMON}" ]]; then
+  exec python /usr/app/update-display.py
+fi
+
 # Run the display update once on container start
 python /usr/app/update-display.py
 
@@ -0,0 +1,30 @@
+"""Tests for the local quote store. Run from the inkyshot directory with `python -m unittest`"""
+from pathlib import Path
+import tempfile
+import unittest
+
+from lib.quotes import QuoteStore
+
+
+class QuoteStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = QuoteStore(Path(directory.name) / "quotes.sqlite")
+
+    def test_quote_of_the_day(self):
+        self.store.add("inspire", "en", [("Be yourself.", "Oscar Wilde")], "2024-01-01")
+        self.assertEqual(self.store.quote_of_the_day("inspire", "en", "2024-01-01"), "Be yourself.")
+        self.assertIsNone(self.store.quote_of_the_day("inspire", "en", "2024-01-02"))
+
+    def test_repeated_quote_of_the_day(self):
+        self.store.add("inspire", "en", [("Be yourself.", "Oscar Wilde")], "2024-01-01")
+        self.store.add("inspire", "en", [("Keep going.", None)], "2024-01-02")
+        # quotes.rest sends a quote that was the quote of an earlier day again
+        self.store.add("inspire", "en", [("Be yourself.", "Oscar Wilde")], "2024-01-03")
+        self.assertEqual(self.store.quote_of_the_day("inspire", "en", "2024-01-03"), "Be yourself.")
+        self.assertEqual(self.store.pick("inspire", "en"), "Keep going.")
+
+
+if __name__ == "__main__":
+    unittest.main()
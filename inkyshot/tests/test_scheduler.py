@@ -0,0 +1,27 @@
+"""Tests for the daemon mode scheduler. Run from the inkyshot directory with `python -m unittest`"""
+from datetime import datetime
+import unittest
+
+from lib.scheduler import Schedule, following_run
+
+
+class FollowingRunTest(unittest.TestCase):
+    def test_next_slot(self):
+        schedule = Schedule(alternate_frequency=15)
+        run = following_run(schedule, datetime(2024, 1, 1, 9, 0), datetime(2024, 1, 1, 9, 2))
+        self.assertEqual(run, datetime(2024, 1, 1, 9, 15))
+
+    def test_missed_slots_run_once(self):
+        schedule = Schedule(alternate_frequency=15)
+        # The update at 9:00 overran past the 9:15 and 9:30 slots
+        run = following_run(schedule, datetime(2024, 1, 1, 9, 0), datetime(2024, 1, 1, 9, 40))
+        self.assertEqual(run, datetime(2024, 1, 1, 9, 30))
+
+    def test_missed_daily_slot(self):
+        schedule = Schedule(update_hour=9)
+        run = following_run(schedule, datetime(2024, 1, 1, 9, 0), datetime(2024, 1, 2, 9, 5))
+        self.assertEqual(run, datetime(2024, 1, 2, 9, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
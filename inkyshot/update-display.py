@@ -1,3 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import datetime
+import email.utils
+import functools
+import hashlib
+import io
 import json
 import logging
 import math
@@ -6,20 +12,35 @@ import os
 from os import environ
 import sys
 import textwrap
+import threading
 import time
-
-from font_amatic_sc import AmaticSC
-from font_caladea import Caladea
-from font_fredoka_one import FredokaOne
-from font_hanken_grotesk import HankenGrotesk
-from font_intuitive import Intuitive
-from font_roboto import Roboto
-from font_source_sans_pro import SourceSansPro
-from font_source_serif_pro import SourceSerifPro
-from PIL import Image, ImageFont, ImageDraw, ImageOps
-import arrow
-import geocoder
-import requests
+from urllib.parse import quote as url_quote
+import zipfile
+
+from lib.startup import LazyModule, import_module, profile
+
+# Print where start-up time goes once the first update is done
+PROFILE_STARTUP = "--profile-startup" in sys.argv or "PROFILE_STARTUP" in os.environ
+profile.enabled = PROFILE_STARTUP
+
+with profile.stage("import PIL"):
+    from PIL import Image, ImageFont, ImageDraw, ImageOps
+
+# Only imported once the chosen display mode needs them
+arrow = LazyModule("arrow")
+geocoder = LazyModule("geocoder")
+np = LazyModule("numpy")
+requests = LazyModule("requests")
+
+from lib.datacache import DataCache
+from lib.display import open_display
+from lib.dither import METHODS as DITHER_METHODS, dither
+from lib.forecast import parse_forecast
+from lib.metrics import Metrics
+from lib.quotes import QuoteStore
+from lib.refresh import FrameStore, RefreshPolicy
+from lib.rendercache import RenderCache, file_version
+from lib.worker import DisplayWorker
 
 icon_map = {
     "clearsky": 1,
@@ -69,30 +90,128 @@ def create_mask(source):
     """Create a transparency mask to draw images in grayscale
     """
     logging.info("Creating a transparency mask for the image")
-    mask_image = Image.new("1", source.size)
-    w, h = source.size
-    for x in range(w):
-        for y in range(h):
-            p = source.getpixel((x, y))
-            if p in [BLACK, WHITE]:
-                mask_image.putpixel((x, y), 255)
-    return mask_image
+    return Image.fromarray(np.isin(np.asarray(source), [BLACK, WHITE]))
+
+# Weather icons and their masks, keyed by icon file name and display palette
+icon_cache = {}
+ICON_CACHE_DIR = Path(__file__).parent / 'weather-icons-cache'
+
+def load_icon(icon_filename):
+    """Return a weather icon and its transparency mask for the current display palette.
+    Both are cached in memory and on disk so the PNG is only decoded once.
+    """
+    key = (icon_filename, BLACK, WHITE)
+    if key in icon_cache:
+        return icon_cache[key]
+    cache_path = ICON_CACHE_DIR / f"{Path(icon_filename).stem}-{BLACK}-{WHITE}.npz"
+    try:
+        with np.load(cache_path) as cached:
+            pixels = cached['pixels']
+            icon_image = Image.frombytes('P', (pixels.shape[1], pixels.shape[0]), pixels.tobytes())
+            icon_image.putpalette(cached['palette'].tobytes())
+            if cached['transparency'] >= 0:
+                icon_image.info['transparency'] = int(cached['transparency'])
+            icon_mask = Image.fromarray(cached['mask'])
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # A missing or damaged cache file is rebuilt from the icon
+        icon_image = Image.open(Path(__file__).parent / 'weather-icons' / icon_filename)
+        icon_image.load()
+        icon_mask = create_mask(icon_image)
+        try:
+            ICON_CACHE_DIR.mkdir(exist_ok=True)
+            # Written under a name unique to the process and replaced in one go, so an interrupted write or
+            # render server processes caching the same icon can't leave a truncated file behind
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as cache_file:
+                np.savez(
+                    cache_file,
+                    pixels=np.asarray(icon_image),
+                    palette=np.frombuffer(bytes(icon_image.getpalette()), dtype=np.uint8),
+                    transparency=icon_image.info['transparency'] if isinstance(icon_image.info.get('transparency'), int) else -1,
+                    mask=np.asarray(icon_mask),
+                )
+            os.replace(tmp_path, cache_path)
+        except OSError as err:
+            logging.error(f"Failed to cache weather icon {icon_filename}: {err}")
+    icon_cache[key] = (icon_image, icon_mask)
+    return icon_cache[key]
+
+# Fonts that can be picked with FONT and WEATHER_FONT, mapped to the pip package providing them.
+# Packages are only imported when their font is used.
+PIP_FONTS = {
+    "AmaticSC": "font_amatic_sc",
+    "Caladea": "font_caladea",
+    "FredokaOne": "font_fredoka_one",
+    "HankenGrotesk": "font_hanken_grotesk",
+    "Intuitive": "font_intuitive",
+    "Roboto": "font_roboto",
+    "SourceSansPro": "font_source_sans_pro",
+    "SourceSerifPro": "font_source_serif_pro",
+}
 
 # Declare non pip fonts here ** Note: ttf files need to be in the /fonts dir of application repo
-Grand9KPixel = "/usr/app/fonts/Grand9KPixel.ttf"
+LOCAL_FONTS = {
+    "Grand9KPixel": str(Path(__file__).parent / "fonts" / "Grand9KPixel.ttf"),
+}
+
+def font_path(name):
+    """Return the font file for a font name"""
+    if name in LOCAL_FONTS:
+        return LOCAL_FONTS[name]
+    return getattr(import_module(PIP_FONTS[name]), name)
+
+@functools.lru_cache(maxsize=16)
+def load_font(path, size):
+    """Return a loaded font, shared between renders so each font file and size is only parsed once"""
+    return ImageFont.truetype(path, size)
+
+def preload_fonts():
+    """Load the fonts the configured mode draws with ahead of the first update"""
+    if MODE in ('quote', 'alternate'):
+        load_font(font_path(FONT_SELECTED), FONT_SIZE)
+        load_font(font_path("Grand9KPixel"), 8)
+    if MODE in ('weather', 'alternate'):
+        for size in (18, 24, 14):
+            load_font(font_path(WEATHER_FONT), size)
+
+def font_setting(variable, default):
+    """Read a font name from the environment, falling back to the default if it's unknown"""
+    name = os.environ[variable] if variable in os.environ else default
+    if name not in PIP_FONTS and name not in LOCAL_FONTS:
+        logging.error(f"Unknown font {name} set in {variable}, using {default}")
+        return default
+    return name
+
+def weather_date():
+    """Return today's date as drawn on the weather screen"""
+    return arrow.utcnow().format(fmt="DD MMMM", locale=LOCALE)
+
+def icon_filename(symbol):
+    """Return the icon file for a forecast symbol code"""
+    icon_name = symbol.split('_')[0]
+    time_of_day = ''
+    # Couple of symbols have different icons for day and night. Check if this symbol is one of them.
+    if len(symbol.split('_')) > 1:
+        symbol_cycle = symbol.split('_')[1]
+        if symbol_cycle == 'day':
+            time_of_day = 'd'
+        elif symbol_cycle == 'night':
+            time_of_day = 'n'
+    return f"{icon_map[icon_name]:02}{time_of_day}.png"
 
 def draw_weather(weather, img, scale):
     """Draw the weather info on screen"""
     logging.info("Prepare the weather data for drawing")
+    draw = ImageDraw.Draw(img)
     # Draw today's date on left side below today's name
-    today = arrow.utcnow().format(fmt="DD MMMM", locale=LOCALE)
-    date_font = ImageFont.truetype(WEATHER_FONT, 18)
+    today = weather_date()
+    date_font = load_font(font_path(WEATHER_FONT), 18)
     draw.text((3, 3), today, BLACK, font=date_font)
     # Draw current temperature to right of today
-    temp_font = ImageFont.truetype(WEATHER_FONT, 24)
+    temp_font = load_font(font_path(WEATHER_FONT), 24)
     draw.text((3, 30), f"{temp_to_str(weather['temperature'], scale)}°", BLACK, font=temp_font)
     # Draw today's high and low temps on left side below date
-    small_font = ImageFont.truetype(WEATHER_FONT, 14)
+    small_font = load_font(font_path(WEATHER_FONT), 14)
     draw.text(
         (3, 72),
         f"{temp_to_str(weather['min_temp'], scale)}° - {temp_to_str(weather['max_temp'], scale)}°",
@@ -102,37 +221,78 @@ def draw_weather(weather, img, scale):
     # Draw today's max humidity on left side below temperatures
     draw.text((3, 87), f"{weather['max_humidity']}%", BLACK, font=small_font)
     # Load weather icon
-    icon_name = weather['symbol'].split('_')[0]
-    time_of_day = ''
-    # Couple of symbols have different icons for day and night. Check if this symbol is one of them.
-    if len(weather['symbol'].split('_')) > 1:
-        symbol_cycle = weather['symbol'].split('_')[1]
-        if symbol_cycle == 'day':
-            time_of_day = 'd'
-        elif symbol_cycle == 'night':
-            time_of_day = 'n'
-    icon_filename = f"{icon_map[icon_name]:02}{time_of_day}.png"
-    filepath = Path(__file__).parent / 'weather-icons' / icon_filename
-    icon_image = Image.open(filepath)
-    icon_mask = create_mask(icon_image)
+    icon_image, icon_mask = load_icon(icon_filename(weather['symbol']))
     # Draw the weather icon
-    if WEATHER_INVERT and WAVESHARE:
+    if WEATHER_INVERT:
         logging.info("Inverting Weather Icon")
-        icon = Image.new('1', (100, 100), 255)
+        icon = backend.new_image(icon_image.size)
         icon.paste(icon_image, (0,0), icon_mask)
-        icon_inverted = ImageOps.invert(icon.convert('RGB'))
-        img.paste(icon_inverted, (120, 3))
+        img.paste(backend.invert(icon), (120, 3))
     else:
         img.paste(icon_image, (120, 3), icon_mask)
     return img
 
+def load_image_source():
+    """Return the contents of the image file or URL set in IMAGE_SOURCE, or None if it can't be read"""
+    if IMAGE_SOURCE.startswith(("http://", "https://")):
+        response = get_client().get(IMAGE_SOURCE, conditional=True)
+        if response.status_code != 200:
+            logging.error(f"Image request failed with status {response.status_code}")
+            return None
+        return response.content
+    try:
+        return Path(IMAGE_SOURCE).read_bytes()
+    except OSError as err:
+        logging.error(f"Failed to read the image: {err}")
+        return None
+
+def draw_image(source):
+    """Scale an image to the display and dither it to the display's colours"""
+    logging.info("Dithering the image with %s", DITHER)
+    picture = ImageOps.exif_transpose(Image.open(io.BytesIO(source)))
+    if picture.mode in ("RGBA", "LA", "PA") or "transparency" in picture.info:
+        # Transparent parts would turn black when the alpha is dropped, so lay the picture on white
+        picture = picture.convert("RGBA")
+        picture = Image.alpha_composite(Image.new("RGBA", picture.size, "white"), picture)
+    picture = ImageOps.pad(picture.convert("RGB"), (WIDTH, HEIGHT), color="white")
+    indices = dither(picture, [rgb for _, rgb in backend.palette], DITHER)
+    return backend.from_indices(np.array([index for index, _ in backend.palette], dtype=np.uint8)[indices])
+
+def load_display_state():
+    """Return the locally stored current display and the value last synced to the device tag"""
+    try:
+        return json.loads(DISPLAY_STATE_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+def save_display_state(**changes):
+    """Update the locally stored display state"""
+    with display_state_lock:
+        state = load_display_state()
+        state.update(changes)
+        try:
+            DISPLAY_STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = DISPLAY_STATE_PATH.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(state))
+            os.replace(tmp_path, DISPLAY_STATE_PATH)
+        except OSError as err:
+            logging.error(f"Failed to save the display state: {err}")
+
 def get_current_display():
+    """Return the current display. The local state is authoritative, the device tag is only read
+    until the first display has been stored locally"""
+    state = load_display_state()
+    if "current_display" in state:
+        return state["current_display"]
+    return get_current_display_tag()
+
+def get_current_display_tag():
     """Query device supervisor API to retrieve the current display"""
     url = f"{BALENA_SUPERVISOR_ADDRESS}/v2/device/tags?apikey={BALENA_SUPERVISOR_API_KEY}"
     headers = {"Accept": "application/json"}
     current_display = None
     try:
-        response = requests.get(url, headers=headers)
+        response = get_client().get(url, headers=headers)
         if response.status_code == 200:
             data = response.json()
             if "tags" in data:
@@ -146,7 +306,7 @@ def get_location():
     url = "https://ipinfo.io"
     headers = {"Accept": "application/json"}
     try:
-        response = requests.get(url, headers=headers)
+        response = get_client().get(url, headers=headers)
         if response.status_code == 200:
             return response.json()
     except requests.exceptions.RequestException as err:
@@ -154,73 +314,91 @@ def get_location():
     logging.error("Failed to retrieve the location data")
     return {}
 
-def get_weather(lat: float, lon: float):
-    """Return weather report for the next 24 hours"""
+def expires_in(response, default=3600):
+    """Return the seconds until a response's Expires header, or the default if it has none"""
+    try:
+        expires = email.utils.parsedate_to_datetime(response.headers["Expires"]).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return default
+    return max(expires - time.time(), 60)
+
+def fetch_forecast(lat: float, lon: float):
+    """Download the forecast timeseries, which stays valid until the Expires header of the response.
+    A cached forecast is revalidated, so it's only downloaded again once it has changed."""
+    from lib.client import validators_of
     # Truncate all geographical coordinates to max 4 decimals to respect API's policy
     url = f"https://api.met.no/weatherapi/locationforecast/2.0/compact?lat={lat:.4f}&lon={lon:.4f}"
     headers = {
         "Accept": "application/json",
         "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/84.0.4147.135 Safari/537.36"
     }
+    cached = data_cache.load("forecast", key=f"{lat:.4f},{lon:.4f}")
+    validators = cached.get("validators") if cached is not None else None
     logging.info("Retrieving weather forecast")
+    response = get_client().get(url, headers=headers, conditional=True, validators=validators)
+    if response.status_code == 304 and cached is not None:
+        logging.info("Weather forecast not modified")
+        return cached["value"], expires_in(response), validators
+    if response.status_code != 200:
+        logging.error(f"Weather forecast request failed with status {response.status_code}")
+        return None, None
+    return response.json()['properties']['timeseries'], expires_in(response), validators_of(response)
+
+def get_weather(lat: float, lon: float):
+    """Return weather report for the next 24 hours"""
     weather = {}
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            timeseries = data['properties']['timeseries']
-            now = arrow.utcnow()
-            tomorrow = now.shift(hours=+24)
-            weather_24hours = []
-            for t in timeseries:
-                tm = arrow.get(t['time'])
-                if tm < tomorrow:
-                    temp = t['data']['instant']['details']['air_temperature']
-                    humid = t['data']['instant']['details']['relative_humidity']
-                    symbol = t['data']['next_1_hours']['summary']['symbol_code']
-                    weather_24hours.append({
-                        'time': tm,
-                        'temperature': temp,
-                        'humidity': humid,
-                        'symbol': symbol,
-                    })
-            weather_24hours = sorted(weather_24hours, key=lambda x: x['time'])
-            weather = [x for x in weather_24hours if x['time'] <= now.shift(hours=+1)][-1]
-            temperatures = [x['temperature'] for x in weather_24hours if x['time'] <= now.shift(days=+1)]
-            weather['max_temp'] = max(temperatures)
-            weather['min_temp'] = min(temperatures)
-            weather['max_humidity'] = max([x['humidity'] for x in weather_24hours if x['time'] <= now.shift(days=+1)])
-    except requests.exceptions.RequestException as err:
-        logging.error(err)
+    timeseries = data_cache.get("forecast", lambda: fetch_forecast(lat, lon), key=f"{lat:.4f},{lon:.4f}")
+    if timeseries:
+        weather = parse_forecast(timeseries)
     return weather
 
+def get_device_id():
+    """Return the balena device id, which is cached on disk for the device UUID"""
+    def fetch():
+        url_device = f"https://api.balena-cloud.com/v5/device?$filter=uuid eq '{BALENA_DEVICE_UUID}'&$select=id"
+        headers = {"Accept": "application/json", "Authorization": f"Bearer {BALENA_API_KEY}"}
+        response = get_client().get(url_device, headers=headers)
+        if response.status_code != 200:
+            return None, None
+        data = response.json()
+        return (data['d'][0]['id'] if 'd' in data and len(data['d']) > 0 else None), None
+    return data_cache.get("device_id", fetch, key=BALENA_DEVICE_UUID)
+
 def set_current_display(val):
+    """Store the current display locally and sync the device tag in the background if it changed"""
+    state = load_display_state()
+    save_display_state(current_display=val)
+    if state.get("synced") == val:
+        return None
+    # Not a daemon thread, so a one-off run waits for the sync before exiting. Set explicitly, as this
+    # runs on the display worker, whose threads would otherwise be daemons too
+    threading.Thread(target=sync_current_display_tag, args=(val, state.get("synced")), name="sync-tag", daemon=False).start()
+
+def sync_current_display_tag(val, synced):
     """Update the tag value for current display"""
-    # First get device identifier for future call
-    url_device = f"https://api.balena-cloud.com/v5/device?$filter=uuid eq '{BALENA_DEVICE_UUID}'&$select=id"
     url_device_tag = "https://api.balena-cloud.com/v5/device_tag"
     headers = {"Accept": "application/json", "Authorization": f"Bearer {BALENA_API_KEY}"}
     try:
-        response = requests.get(url_device, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            device_id = data['d'][0]['id'] if 'd' in data and len(data['d']) > 0 else None
-            request_data = {
-                "device": device_id,
-                "tag_key": "current_display",
-                "value": val
-            }
-            request_data = {"device": device_id, "tag_key": "current_display", "value": val }
-            current_display = get_current_display()
-            if current_display:
-                if current_display == val:
-                    # No need to modify the tag
-                    return None
+        device_id = get_device_id()
+        if device_id is None:
+            logging.error(f"Failed to set current display to {val}. Device id not found")
+            return None
+        request_data = {"device": device_id, "tag_key": "current_display", "value": val }
+        # Only ask the supervisor whether the tag exists if it has never been synced
+        current_display = synced if synced is not None else get_current_display_tag()
+        response = None
+        if current_display:
+            if current_display != val:
                 # Let's modify the existing tag with the new val
-                requests.patch(url_device_tag, data=request_data, headers=headers)
-            else:
-                # No tag exists yet, so let's create it
-                requests.post(url_device_tag, data=request_data, headers=headers)
+                response = get_client().patch(url_device_tag, data=request_data, headers=headers)
+        else:
+            # No tag exists yet, so let's create it
+            response = get_client().post(url_device_tag, data=request_data, headers=headers)
+        # Only a tag that was written counts as synced, otherwise the next sync checks it again
+        if response is not None and not 200 <= response.status_code < 300:
+            logging.error(f"Failed to set current display to {val}. Request failed with status {response.status_code}")
+            return None
+        save_display_state(synced=val)
     except requests.exceptions.RequestException as err:
         logging.error(f"Failed to set current display to {val}. Error is: {err}")
 
@@ -236,10 +414,19 @@ if "DEBUG" in os.environ:
 else:
     logging.basicConfig(level=logging.INFO)
 
+# Shared HTTP client so connections are reused between requests, created on first use
+client = None
+
+def get_client():
+    """Return the shared HTTP client"""
+    global client
+    if client is None:
+        from lib.client import Client
+        client = Client()
+    return client
+
 # Assume a default font if none set
-FONT_SELECTED = AmaticSC
-if "FONT" in os.environ:
-    FONT_SELECTED = locals()[os.environ["FONT"]]
+FONT_SELECTED = font_setting("FONT", "AmaticSC")
 
 FONT_SIZE = 24
 if "FONT_SIZE" in os.environ:
@@ -255,11 +442,7 @@ LANGUAGE = "en"
 if "QOD_LANGUAGE" in os.environ:
     LANGUAGE = os.environ['QOD_LANGUAGE']
 
-FONT = ImageFont.truetype(FONT_SELECTED, FONT_SIZE)
-
-WEATHER_FONT = FredokaOne
-if "WEATHER_FONT" in os.environ:
-    WEATHER_FONT = locals()[os.environ["WEATHER_FONT"]]
+WEATHER_FONT = font_setting("WEATHER_FONT", "FredokaOne")
 
 WEATHER_INVERT = True if "WEATHER_INVERT" in os.environ else False
 
@@ -274,6 +457,10 @@ LOCALE = os.environ["LOCALE"] if "LOCALE" in os.environ else 'en'
 # Display mode of Inkyshot
 MODE = os.environ["MODE"] if "MODE" in os.environ else 'quote'
 
+# Image shown in image mode, a file path or URL, and how to dither it to the display's colours
+IMAGE_SOURCE = os.environ["IMAGE_SOURCE"] if "IMAGE_SOURCE" in os.environ else ""
+DITHER = os.environ["DITHER"] if os.environ.get("DITHER") in DITHER_METHODS else "floyd-steinberg"
+
 # Read balena variables for balena API calls
 BALENA_API_KEY = os.environ["BALENA_API_KEY"]
 BALENA_DEVICE_UUID = os.environ["BALENA_DEVICE_UUID"]
@@ -282,150 +469,521 @@ BALENA_SUPERVISOR_API_KEY = os.environ["BALENA_SUPERVISOR_API_KEY"]
 
 WAVESHARE = True if "WAVESHARE" in os.environ else False
 
-# Init the display. TODO: support other colours
-logging.debug("Init and Clear")
-if WAVESHARE:
-    logging.info("Display type: Waveshare")
-
-    import lib.epd2in13_V2
-    display = lib.epd2in13_V2.EPD()
-    display.init(display.FULL_UPDATE)
-    display.Clear(0xFF)
-    # These are the opposite of what InkyPhat uses.
-    WIDTH = display.height # yes, Height
-    HEIGHT = display.width # yes, width
-    BLACK = 0
-    WHITE = 1
-    img = Image.new('1', (WIDTH, HEIGHT), 255)
-else:
-    import inky
-    display = inky.auto()
-    logging.info("Display type: " + type(display).__name__)
-    display.set_border(display.WHITE)
-    WIDTH = display.WIDTH
-    HEIGHT = display.HEIGHT
-    BLACK = display.BLACK
-    WHITE = display.WHITE
-    img = Image.new("P", (WIDTH, HEIGHT))
-
-draw = ImageDraw.Draw(img)
+# Fetch frames drawn by a render server (see render-server.py) instead of drawing them on the device
+RENDER_SERVER = os.environ["RENDER_SERVER"].rstrip("/") if os.environ.get("RENDER_SERVER") else None
 
-logging.info("Display dimensions: W %s x H %s", WIDTH, HEIGHT)
+# Name of this device's profile on the render server
+RENDER_PROFILE = os.environ["RENDER_PROFILE"] if "RENDER_PROFILE" in os.environ else os.environ.get("DEVICE_NAME", BALENA_DEVICE_UUID)
+
+# Persistent storage for state kept between updates
+DATA_DIR = os.environ["DATA_DIR"] if "DATA_DIR" in os.environ else "/data"
+
+# Number of partial refreshes allowed before a full refresh clears any ghosting. 0 disables partial refreshes
+MAX_PARTIAL_REFRESHES = int(os.environ["MAX_PARTIAL_REFRESHES"]) if "MAX_PARTIAL_REFRESHES" in os.environ else 10
+
+# Largest fraction of pixels a partial refresh may change
+PARTIAL_MAX_CHANGE = float(os.environ["PARTIAL_MAX_CHANGE"]) if "PARTIAL_MAX_CHANGE" in os.environ else 0.25
 
-# Reason the display mode based on environment variables and the current display (logic is explained in the readme)
-current_display = get_current_display()
-target_display = 'quote'
-if MODE == 'weather'  or (MODE == 'alternate' and current_display == 'quote'):
-    target_display = 'weather'
+# Hours after which a full refresh is done even if partials would do. 0 disables it
+FULL_REFRESH_HOURS = float(os.environ["FULL_REFRESH_HOURS"]) if "FULL_REFRESH_HOURS" in os.environ else 24
 
-if target_display == 'weather':
+# Below this temperature (°C, taken from the forecast) only full refreshes are done
+PARTIAL_MIN_TEMPERATURE = float(os.environ["PARTIAL_MIN_TEMPERATURE"]) if "PARTIAL_MIN_TEMPERATURE" in os.environ else 0
+
+# Size in kB of the cache of drawn frames. 0 disables it
+RENDER_CACHE_SIZE = int(os.environ["RENDER_CACHE_SIZE"]) if "RENDER_CACHE_SIZE" in os.environ else 1024
+
+# Seconds to wait before trying to fetch the quote of the day again after a failure
+QUOTE_RETRY_INTERVAL = int(os.environ["QUOTE_RETRY_INTERVAL"]) if "QUOTE_RETRY_INTERVAL" in os.environ else 15 * 60
+
+# Seconds to wait for all the data of an update to be fetched
+FETCH_DEADLINE = int(os.environ["FETCH_DEADLINE"]) if "FETCH_DEADLINE" in os.environ else 30
+
+# Draw to a simulated display instead of the panel, see lib/simulator.py
+SIMULATOR = True if "DISPLAY_SIMULATOR" in os.environ else False
+
+# Write the metrics of every update to this file for the node_exporter textfile collector
+METRICS_TEXTFILE = os.environ["METRICS_TEXTFILE"] if "METRICS_TEXTFILE" in os.environ else None
+
+# Serve the metrics over HTTP on this port in daemon mode
+METRICS_PORT = int(os.environ["METRICS_PORT"]) if "METRICS_PORT" in os.environ else None
+
+# Run as a resident process with an in-process scheduler instead of being started by cron
+DAEMON = True if "DAEMON" in os.environ else False
+
+# Init the display
+logging.debug("Init")
+with profile.stage("display init"):
+    backend = open_display(WAVESHARE, SIMULATOR)
+logging.info("Display type: " + type(backend.panel).__name__)
+WIDTH = backend.width
+HEIGHT = backend.height
+BLACK = backend.black
+WHITE = backend.white
+
+logging.info("Display dimensions: W %s x H %s", WIDTH, HEIGHT)
+
+frame_store = FrameStore(DATA_DIR)
+refresh_policy = RefreshPolicy(
+    partial="partial" in backend.refresh_modes,
+    max_partials=MAX_PARTIAL_REFRESHES,
+    max_change=PARTIAL_MAX_CHANGE,
+    full_interval=FULL_REFRESH_HOURS * 60 * 60,
+    min_temperature=PARTIAL_MIN_TEMPERATURE,
+)
+# The latest current temperature from the forecast, which partial refreshes depend on
+ambient_temperature = None
+data_cache = DataCache(Path(DATA_DIR) / "cache")
+quote_store = QuoteStore(Path(DATA_DIR) / "quotes.sqlite")
+render_cache = RenderCache(Path(DATA_DIR) / "render-cache", RENDER_CACHE_SIZE * 1024)
+metrics = Metrics(Path(DATA_DIR) / "metrics.json", METRICS_TEXTFILE)
+
+# Only this thread talks to the display once it's initialised
+display_worker = DisplayWorker()
+
+# Which screen was shown last in alternate mode, and the value last written to the device tag
+DISPLAY_STATE_PATH = Path(DATA_DIR) / "current-display.json"
+display_state_lock = threading.Lock()
+
+def geocode(weather_location):
+    """Look up the coordinates of an address"""
+    geo = geocoder.arcgis(weather_location, session=get_client().session, timeout=get_client().timeout("https://geocode.arcgis.com"))
+    return geo.latlng, None
+
+def locate_ip():
+    """Look up the coordinates of the device's IP address"""
+    location = get_location()
+    if 'loc' not in location:
+        return None, None
+    return [float(x) for x in location['loc'].split(',')], None
+
+def get_coordinates():
+    """Return the latitude and longitude for the weather, looking them up only once"""
+    global LAT, LONG
     weather_location = None
     if "WEATHER_LOCATION" in os.environ:
         weather_location = os.environ["WEATHER_LOCATION"]
     # Get the latitute and longitude of the address typed in the env variable if latitude and longitude are not set
+    # Looked up coordinates are cached on disk until the location setting changes
     if weather_location and (not LAT or not LONG):
         logging.info(f"Location is set to {weather_location}")
-        try:
-            geo = geocoder.arcgis(weather_location)
-            [LAT, LONG] = geo.latlng
-        except Exception as e:
-            print(f"Unexpected error: {e.message}")
+        coordinates = data_cache.get("location", lambda: geocode(weather_location), key=weather_location)
+        if coordinates:
+            [LAT, LONG] = coordinates
 
     # If no address or latitute / longitude are found, retrieve location via IP address lookup
     if not LAT or not LONG:
-        location = get_location()
-        [LAT, LONG] = [float(x) for x in location['loc'].split(',')]
-    weather = get_weather(LAT, LONG)
+        coordinates = data_cache.get("location", locate_ip, key="ip")
+        if not coordinates:
+            return None, None
+        [LAT, LONG] = coordinates
     # Set latitude and longituted as environment variables for consecutive calls
     os.environ['LATLONG'] = f"{LAT},{LONG}"
-    # If weather is empty dictionary, fall back to drawing quote
-    if len(weather) > 0:
-        img = draw_weather(weather, img, SCALE)
-    else:
-        target_display = 'quote'
-elif target_display == 'quote':
+    return LAT, LONG
+
+def fetch_quotes():
+    """Download the quote of the day into the quote store and return it"""
+    response = get_client().get(
+        f"https://quotes.rest/qod?category={CATEGORY}&language={LANGUAGE}",
+        headers={"Accept" : "application/json"},
+    )
+    if response.status_code != 200:
+        logging.error(f"Quote request failed with status {response.status_code}")
+        return None
+    quotes = [(q['quote'], q.get('author')) for q in response.json()['contents']['quotes']]
+    quote_store.add(CATEGORY, LANGUAGE, quotes, datetime.date.today().isoformat())
+    return quotes[0][0]
+
+def get_quote():
+    """Return today's quote, fetching it if it isn't stored yet. Without one, the stored quotes take turns"""
+    today = datetime.date.today().isoformat()
+    quote = quote_store.quote_of_the_day(CATEGORY, LANGUAGE, today)
+    # Failed fetches are only retried after a while, as quotes.rest is rate limited
+    if quote is None and quote_store.should_fetch(CATEGORY, LANGUAGE, QUOTE_RETRY_INTERVAL):
+        try:
+            quote = fetch_quotes()
+        except (requests.exceptions.RequestException, KeyError, IndexError, ValueError) as err:
+            logging.error(f"Failed to fetch the quote of the day: {err}")
+    if quote is None:
+        return stored_quote()
+    return quote
+
+def stored_quote():
+    """Return the stored quote that was shown longest ago, or None if there are none"""
+    quote = quote_store.pick(CATEGORY, LANGUAGE)
+    if quote is not None:
+        logging.info("No quote of the day, showing a stored quote")
+    return quote
+
+def get_message():
+    """Return the message to draw and the font size to start fitting it from"""
+    font_size = FONT_SIZE
     # Use a dashboard defined message if we have one, otherwise load a nice quote
     message = os.environ['INKY_MESSAGE'] if 'INKY_MESSAGE' in os.environ else None
     # If message was set but blank, use the device name
     if message == "":
         message = os.environ['DEVICE_NAME']
     elif message is None:
-        try:
-            response = requests.get(
-                f"https://quotes.rest/qod?category={CATEGORY}&language={LANGUAGE}",
-                headers={"Accept" : "application/json"}
-            )
-            data = response.json()
-            message = data['contents']['quotes'][0]['quote']
-        except requests.exceptions.RequestException as err:
-            logging.error(err)
-            FONT_SIZE = 25
-            message = "Sorry folks, today's quote has gone walkies :("
-
-    logging.info("Message: %s", message)
-    # Work out what size font is required to fit this message on the display
-    message_does_not_fit = True
-
-    test_character = "a"
-    if "TEST_CHARACTER" in os.environ:
-        test_character = os.environ['TEST_CHARACTER']
-
-    while message_does_not_fit == True:
-        test_message = ""
-        message_width = 0
-        FONT_SIZE -= 1
-
-        if FONT_SIZE <= 17:
-            FONT_SIZE = 8
-            FONT = ImageFont.truetype("/usr/app/fonts/Grand9KPixel.ttf", FONT_SIZE)
-
+        message = get_quote()
+    if message is None:
+        font_size = 25
+        message = "Sorry folks, today's quote has gone walkies :("
+    return message, font_size
+
+# How many test characters fill the display width and their height, keyed by font file, size and character
+text_metrics_cache = {}
+
+def text_metrics(draw, font, test_character):
+    """Return the number of test characters needed to fill the display width, and the height of that line"""
+    key = (font.path, font.size, test_character, WIDTH)
+    if key not in text_metrics_cache:
+        # Estimate the count from the character's advance, then correct it with a couple of real measurements
+        advance = font.getlength(test_character)
+        count = max(1, math.ceil(WIDTH / advance)) if advance > 0 else 1
+        message_width, message_height = draw.textsize(test_character * count, font=font)
+        while message_width < WIDTH:
+            count += 1
+            message_width, message_height = draw.textsize(test_character * count, font=font)
+        while count > 1:
+            shorter_width, shorter_height = draw.textsize(test_character * (count - 1), font=font)
+            if shorter_width < WIDTH:
+                break
+            count, message_height = count - 1, shorter_height
+        text_metrics_cache[key] = (count, message_height)
+    return text_metrics_cache[key]
+
+def quote_font(font_size):
+    """Return the font the quote is drawn with at a given size. Sizes above 17 use the
+    configured font at FONT_SIZE, anything smaller falls back to the pixel font at 8"""
+    if font_size <= 17:
+        return load_font(font_path("Grand9KPixel"), 8)
+    return load_font(font_path(FONT_SELECTED), FONT_SIZE)
+
+def fit_quote(draw, message, font_size, test_character):
+    """Find the largest font size below font_size that fits the wrapped message on the display.
+    Returns the size, font and wrapped lines."""
+    def layout(size):
+        font = quote_font(size)
         # We're using the test character here to work out how many characters
         # can fit on the display when using the chosen font
-        while message_width < WIDTH:
-            test_message += test_character
-            message_width, message_height = draw.textsize(test_message, font=FONT)
-
-        max_width = len(test_message)
+        max_width, message_height = text_metrics(draw, font, test_character)
         max_lines = math.floor(HEIGHT/message_height)
-
         # We wrap the message to the width we worked out earlier
         wrapper = textwrap.TextWrapper(width=max_width)
         word_list = wrapper.wrap(text=message)
+        return font, word_list, len(word_list) <= max_lines
+
+    # Smaller sizes never need more lines, so binary search for the largest size that fits
+    start = time.monotonic()
+    attempts = 0
+    low, high = 18, font_size - 1
+    best = None
+    while low <= high:
+        size = (low + high) // 2
+        font, word_list, fits = layout(size)
+        attempts += 1
+        if fits:
+            best = (size, font, word_list)
+            low = size + 1
+        else:
+            high = size - 1
+    if best is None:
+        # Nothing fits, use the pixel font even if the message overflows
+        font, word_list, _ = layout(8)
+        attempts += 1
+        best = (8, font, word_list)
+    logging.debug("Font fit took %s attempts in %.1f ms", attempts, (time.monotonic() - start) * 1000)
+    metrics.set("font_fit_attempts", attempts)
+    return best
+
+def draw_quote(message, img, font_size):
+    """Draw the message on screen using the largest font that fits"""
+    draw = ImageDraw.Draw(img)
+    logging.info("Message: %s", message)
 
-        if len(word_list) <= max_lines:
-            message_does_not_fit = False
+    test_character = "a"
+    if "TEST_CHARACTER" in os.environ:
+        test_character = os.environ['TEST_CHARACTER']
 
-        if FONT_SIZE < 9:
-            message_does_not_fit = False
+    # Work out what size font is required to fit this message on the display
+    font_size, font, word_list = fit_quote(draw, message, font_size, test_character)
 
-    logging.info("Font size: %s", FONT_SIZE)
-    offset_x, offset_y = FONT.getoffset(message)
+    logging.info("Font size: %s", font_size)
+    offset_x, offset_y = font.getoffset(message)
 
     # Rejoin the wrapped lines with newline chars
     separator = '\n'
     output_text = separator.join(word_list)
 
-    w, h = draw.multiline_textsize(output_text, font=FONT, spacing=0)
+    w, h = draw.multiline_textsize(output_text, font=font, spacing=0)
 
     x = (WIDTH - w)/2
     y = (HEIGHT - h - offset_y)/2
-    draw.multiline_text((x, y), output_text, BLACK, FONT, align="center", spacing=0)
+    draw.multiline_text((x, y), output_text, BLACK, font, align="center", spacing=0)
+    return img
+
+@functools.lru_cache(maxsize=1)
+def code_version():
+    """Return a hash of the code that draws and packs frames"""
+    digest = hashlib.sha256()
+    lib = Path(__file__).parent / "lib"
+    for path in (Path(__file__), lib / "display.py", lib / "dither.py", lib / "epd2in13_V2.py"):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+def display_render_inputs():
+    """Return everything besides the content that a frame depends on"""
+    return [code_version(), backend.name, WIDTH, HEIGHT, backend.palette, "ROTATE" in os.environ]
+
+def weather_render_inputs(weather):
+    """Return everything the weather screen is drawn from"""
+    fields = ['temperature', 'min_temp', 'max_temp', 'max_humidity', 'symbol']
+    return [
+        weather_date(), [weather[f] for f in fields], SCALE, WEATHER_INVERT,
+        file_version(font_path(WEATHER_FONT)),
+        file_version(Path(__file__).parent / 'weather-icons' / icon_filename(weather['symbol'])),
+    ]
+
+def quote_render_inputs(message, font_size):
+    """Return everything the quote screen is drawn from"""
+    test_character = os.environ['TEST_CHARACTER'] if "TEST_CHARACTER" in os.environ else "a"
+    return [
+        message, font_size, FONT_SIZE, test_character,
+        file_version(font_path(FONT_SELECTED)), file_version(font_path("Grand9KPixel")),
+    ]
+
+def fetch_frame(target_display):
+    """Return the screen shown and the packed frame from the render server, or None if it has none.
+    The server answers with the screen it drew, which is the quote if it couldn't draw the target display."""
+    global ambient_temperature
+    url = f"{RENDER_SERVER}/frames/{url_quote(RENDER_PROFILE, safe='')}/{target_display}"
+    try:
+        response = get_client().get(url, conditional=True)
+    except requests.exceptions.RequestException as err:
+        logging.error(f"Failed to fetch the frame from the render server: {err}")
+        return None
+    if response.status_code != 200:
+        logging.error(f"Frame request failed with status {response.status_code}")
+        return None
+    frame = response.content
+    if len(frame) != backend.frame_size:
+        logging.error(f"Frame for profile {RENDER_PROFILE} is {len(frame)} bytes, this display takes {backend.frame_size}")
+        return None
+    if "X-Inkyshot-Temperature" in response.headers:
+        ambient_temperature = float(response.headers["X-Inkyshot-Temperature"])
+    logging.info("Using the %s frame from the render server", target_display)
+    return response.headers.get("X-Inkyshot-Display", target_display), frame
+
+def show_image(frame):
+    """Push the frame to the display with the refresh the policy picks: none if nothing changed,
+    a partial refresh for small changes and a full refresh otherwise"""
+    last_frame, partial_count, last_full = frame_store.load()
+    decision = refresh_policy.decide(
+        last_frame, frame, backend.row_bytes, partial_count, last_full, ambient_temperature,
+        bits_per_pixel=backend.bits_per_pixel,
+    )
+    logging.info("Refresh: %s (%s)", decision.kind, decision.reason)
+    metrics.count(f"refreshes:{decision.kind}")
+
+    if decision.kind == "skip":
+        return
+    timings = backend.timings()
+    start = time.monotonic()
+    kind = backend.push(frame, decision.rows if decision.kind == "partial" else None)
+    if kind == "partial":
+        frame_store.save(frame, partial_count + 1, last_full)
+    else:
+        frame_store.save(frame, 0, time.time())
+    logging.info("%s refresh took %.2f seconds", kind.capitalize(), time.monotonic() - start)
+    metrics.record(f"refresh_{kind}", time.monotonic() - start)
+
+    for name, seconds in backend.timings().items():
+        metrics.record(name, seconds - timings[name])
+
+def fetch_weather():
+    """Return the weather report, or an empty dictionary if it couldn't be retrieved"""
+    lat, lon = timed("location", get_coordinates)
+    if lat is None:
+        return {}
+    return timed("forecast", get_weather, lat, lon)
+
+def timed(name, func, *args):
+    """Call func, logging and recording how long it took"""
+    start = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        logging.info("Fetched %s in %.2f seconds", name, time.monotonic() - start)
+        metrics.record(f"fetch_{name}", time.monotonic() - start)
 
-# Rotate and display the image
-if "ROTATE" in os.environ:
-    img = img.rotate(180)
+def fetch_data(target_display):
+    """Fetch the data for the target display and, when alternating, the next display, all at once.
 
-if WAVESHARE:
-    # epd does not have a set_image method.
-    display.display(display.getbuffer(img))
-else:
-    display.set_image(img)
-    display.show()
+    Returns a dictionary with the "weather", "quote" and "image" results that finished before FETCH_DEADLINE.
+    """
+    tasks = {target_display}
+    if MODE == 'alternate':
+        # Prefetch the next screen so it's already cached when it's due
+        tasks |= {'weather', 'quote'}
+    funcs = {
+        'weather': fetch_weather,
+        'quote': lambda: timed("quote", get_message),
+        'image': lambda: timed("image", load_image_source),
+    }
 
-logging.info("Done drawing")
+    executor = ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="fetch")
+    futures = {name: executor.submit(funcs[name]) for name in tasks}
+    done, not_done = wait(futures.values(), timeout=FETCH_DEADLINE)
+    # Don't wait for stragglers, their requests are bounded by the client timeouts
+    executor.shutdown(wait=False)
+
+    results = {}
+    for name, future in futures.items():
+        if future in not_done:
+            logging.error(f"Fetching {name} missed the {FETCH_DEADLINE} second deadline")
+        elif future.exception() is not None:
+            logging.error(f"Fetching {name} failed: {future.exception()}")
+        else:
+            results[name] = future.result()
+    return results
+
+def prepare_update():
+    """Work out which screen to show next, then fetch, draw and pack it.
+    Returns the target display and the packed frame."""
+    global ambient_temperature
+    # Reason the display mode based on environment variables and the current display (logic is explained in the readme)
+    metrics.begin()
+    # The current display only matters when alternating
+    with metrics.stage("fetch_current_display"):
+        current_display = get_current_display() if MODE == 'alternate' else None
+    target_display = 'quote'
+    if MODE == 'weather'  or (MODE == 'alternate' and current_display == 'quote'):
+        target_display = 'weather'
+    elif MODE == 'image':
+        target_display = 'image'
+
+    if RENDER_SERVER:
+        with metrics.stage("fetch_frame"):
+            prepared = fetch_frame(target_display)
+        if prepared is not None:
+            return prepared
+        logging.info("Drawing the %s frame on the device instead", target_display)
+
+    with metrics.stage("fetch"):
+        data = fetch_data(target_display)
+    if data.get('weather'):
+        ambient_temperature = data['weather']['temperature']
+
+    if target_display == 'weather':
+        weather = data.get('weather', {})
+        # If weather is empty dictionary, fall back to drawing quote
+        if len(weather) > 0:
+            inputs = weather_render_inputs(weather)
+            draw = lambda img: draw_weather(weather, img, SCALE)
+        else:
+            target_display = 'quote'
+    if target_display == 'image':
+        source = data.get('image')
+        # If the image couldn't be loaded, fall back to drawing quote
+        if source:
+            inputs = [hashlib.sha256(source).hexdigest(), DITHER]
+            draw = lambda img: draw_image(source)
+        else:
+            target_display = 'quote'
+    if target_display == 'quote':
+        if 'quote' not in data and MODE in ('weather', 'image'):
+            # Falling back from the weather or image, so the quote wasn't fetched yet
+            data.update(fetch_data('quote'))
+        if 'quote' in data:
+            message, font_size = data['quote']
+        else:
+            # The quote wasn't fetched in time, fall back to one from the store
+            message = stored_quote() if 'INKY_MESSAGE' not in os.environ else None
+            font_size = FONT_SIZE if message else 25
+            message = message or "Sorry folks, today's quote has gone walkies :("
+        inputs = quote_render_inputs(message, font_size)
+        draw = lambda img: draw_quote(message, img, font_size)
+
+    # The same inputs always draw the same frame, so a cached one skips drawing and packing
+    key = render_cache.key(target_display, inputs, display_render_inputs())
+    frame = render_cache.get(key)
+    if frame is not None:
+        logging.info("Using the cached %s frame", target_display)
+        metrics.count("render_cache:hit")
+        return target_display, frame
+    metrics.count("render_cache:miss")
+
+    with metrics.stage(f"draw_{target_display}"):
+        img = draw(backend.new_image())
+
+    # Rotating is done while packing, which reorders the pixels anyway
+    with metrics.stage("pack"):
+        frame = backend.pack(img, rotate="ROTATE" in os.environ)
+    render_cache.put(key, frame)
+    return target_display, frame
+
+def commit_update(prepared):
+    """Hand a prepared screen to the display worker, returning a future that is done once it's shown.
+    If another screen is committed before the display is free, only the newest one is shown."""
+    future = display_worker.submit(show_prepared, *prepared)
+    future.add_done_callback(log_failure)
+    return future
+
+def log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Display update failed", exc_info=future.exception())
+
+def show_prepared(target_display, frame):
+    """Push a prepared screen to the display and record it. Runs on the display worker thread"""
+    with metrics.stage("show"):
+        show_image(frame)
+
+    logging.info("Done drawing")
+
+    # Update device with the current display for ALTERNATE mode
+    if MODE == 'alternate':
+        set_current_display(target_display)
+
+    logging.debug("Font cache: %s", load_font.cache_info())
+    data_cache.log_stats()
+    for result, total in data_cache.stats.items():
+        metrics.count_total(f"data_cache:{result}", total)
+    if client is not None:
+        metrics.count_total("http_retries", client.retries)
+        metrics.count_total("http_errors", client.errors)
+    metrics.finish(display=target_display)
+
+    if profile.enabled:
+        profile.report()
+
+def update_display():
+    """Work out which screen to show, draw it and push it to the display"""
+    return commit_update(prepare_update())
+
+def main():
+    if DAEMON:
+        from lib.scheduler import Schedule, run_forever
+
+        alternate_frequency = int(os.environ["ALTERNATE_FREQUENCY"]) if os.environ.get("ALTERNATE_FREQUENCY") else None
+        update_hour = int(os.environ["UPDATE_HOUR"]) if os.environ.get("UPDATE_HOUR") else 9
+        jitter = int(os.environ["UPDATE_JITTER"]) if "UPDATE_JITTER" in os.environ else 0
+        # Seconds before each update to start preparing it, so only the display refresh is left at update time
+        lead = int(os.environ["PREPARE_LEAD"]) if "PREPARE_LEAD" in os.environ else 30
+        if not RENDER_SERVER:
+            preload_fonts()
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        run_forever(commit_update, Schedule(alternate_frequency, update_hour), jitter, prepare=prepare_update, lead=lead)
+        display_worker.close()
+        backend.sleep()
+    else:
+        future = update_display()
+        display_worker.close()
+        if future.exception() is not None:
+            sys.exit(1)
 
-# Update device with the current display for ALTERNATE mode
-if MODE == 'alternate':
-    set_current_display(target_display)
+    sys.exit(0)
 
-sys.exit(0)
+# Importing this file (e.g. from the benchmarks) sets up the display without updating it
+if __name__ == "__main__":
+    main()